@@ -49,6 +49,64 @@ rev_map = OrderedDict([('VAGUE', 'VAGUE'),
                        ('IS_INCLUDED', 'INCLUDES')
                        ])
 
+# composition of the temporal relations, one rule per row of the
+# transitivity constraints: (r(e1,e2), r(e2,e3)) -> the relations r(e1,e3)
+# may take. Compositions without a rule leave r(e1,e3) free.
+tbd_composition = OrderedDict([(('BEFORE', 'BEFORE'), ('BEFORE',)),
+                               (('AFTER', 'AFTER'), ('AFTER',)),
+                               (('SIMULTANEOUS', 'SIMULTANEOUS'), ('SIMULTANEOUS',)),
+                               (('INCLUDES', 'INCLUDES'), ('INCLUDES',)),
+                               (('IS_INCLUDED', 'IS_INCLUDED'), ('IS_INCLUDED',)),
+                               (('BEFORE', 'VAGUE'), ('BEFORE', 'VAGUE', 'INCLUDES', 'IS_INCLUDED')),
+                               (('BEFORE', 'INCLUDES'), ('BEFORE', 'VAGUE', 'INCLUDES')),
+                               (('BEFORE', 'IS_INCLUDED'), ('BEFORE', 'VAGUE', 'IS_INCLUDED')),
+                               (('AFTER', 'VAGUE'), ('AFTER', 'VAGUE', 'INCLUDES', 'IS_INCLUDED')),
+                               (('AFTER', 'INCLUDES'), ('AFTER', 'VAGUE', 'INCLUDES')),
+                               (('AFTER', 'IS_INCLUDED'), ('AFTER', 'VAGUE', 'IS_INCLUDED')),
+                               (('INCLUDES', 'VAGUE'), ('INCLUDES', 'AFTER', 'VAGUE', 'BEFORE')),
+                               (('INCLUDES', 'BEFORE'), ('INCLUDES', 'VAGUE', 'BEFORE')),
+                               (('INCLUDES', 'AFTER'), ('INCLUDES', 'VAGUE', 'AFTER')),
+                               (('IS_INCLUDED', 'VAGUE'), ('IS_INCLUDED', 'VAGUE', 'BEFORE', 'AFTER')),
+                               (('IS_INCLUDED', 'BEFORE'), ('BEFORE', 'VAGUE', 'IS_INCLUDED')),
+                               (('IS_INCLUDED', 'AFTER'), ('AFTER', 'VAGUE', 'IS_INCLUDED')),
+                               (('VAGUE', 'BEFORE'), ('BEFORE', 'VAGUE', 'INCLUDES', 'IS_INCLUDED')),
+                               (('VAGUE', 'AFTER'), ('AFTER', 'VAGUE', 'INCLUDES', 'IS_INCLUDED')),
+                               (('VAGUE', 'INCLUDES'), ('INCLUDES', 'VAGUE', 'BEFORE', 'AFTER')),
+                               (('VAGUE', 'IS_INCLUDED'), ('IS_INCLUDED', 'VAGUE', 'BEFORE', 'AFTER')),
+                               (('BEFORE', 'SIMULTANEOUS'), ('BEFORE',)),
+                               (('AFTER', 'SIMULTANEOUS'), ('AFTER',)),
+                               (('INCLUDES', 'SIMULTANEOUS'), ('INCLUDES',)),
+                               (('IS_INCLUDED', 'SIMULTANEOUS'), ('IS_INCLUDED',))
+                               ])
+
+# also the table of new_label_map, which has the same labels
+matres_composition = OrderedDict([(('BEFORE', 'BEFORE'), ('BEFORE',)),
+                                  (('AFTER', 'AFTER'), ('AFTER',)),
+                                  (('SIMULTANEOUS', 'SIMULTANEOUS'), ('SIMULTANEOUS',)),
+                                  (('BEFORE', 'VAGUE'), ('BEFORE', 'VAGUE')),
+                                  (('AFTER', 'VAGUE'), ('AFTER', 'VAGUE')),
+                                  (('VAGUE', 'BEFORE'), ('BEFORE', 'VAGUE')),
+                                  (('VAGUE', 'AFTER'), ('AFTER', 'VAGUE')),
+                                  (('BEFORE', 'SIMULTANEOUS'), ('BEFORE',)),
+                                  (('AFTER', 'SIMULTANEOUS'), ('AFTER',))
+                                  ])
+
+def get_composition(labels):
+    # composition table of a temporal label set
+    if 'INCLUDES' in labels:
+        return tbd_composition
+    return matres_composition
+
+def rev_label_ids(data_type):
+    # label id -> id of the reversed label, for the temporal ('L') and the
+    # causal ('C') samples of data_type
+    label_map = {'matres': matres_label_map, 'tbd': tbd_label_map}.get(data_type, new_label_map)
+    rev_ids = {}
+    for kind, labels, rev in (('L', label_map, rev_map), ('C', causal_label_map, rev_causal_map)):
+        labels = list(OrderedDict.fromkeys(labels.values()))
+        rev_ids[kind] = [labels.index(rev[label]) for label in labels]
+    return rev_ids
+
 class EveEveRelModel(abc.ABC):
     def __init__(self):
         pass
@@ -0,0 +1,52 @@
+'''
+Convert the pickled splits to the memory-mapped columns EventDataset reads
+with -data_format mmap: every <split>.pickle under data_dir (all/,
+all_backward/, the cv folds, ...) gets a <split>.mmap/ directory next to it.
+    python convert_data.py -data_dir ../data/
+Splits whose conversion is newer than the pickle are skipped unless -force.
+Each (doc, sentence) is stored once, however many pairs it holds.
+'''
+import argparse
+import json
+import os
+import pickle
+from dataset import write_columns, FORMAT_VERSION
+
+def is_bert(samples):
+    # glove samples hold the tokens, bert ones [features, ...]
+    return len(samples) > 0 and not isinstance(samples[0][4][0][0], str)
+
+def up_to_date(src, dst):
+    meta = os.path.join(dst, 'meta.json')
+    if (not os.path.exists(meta)) or os.path.getmtime(meta) < os.path.getmtime(src):
+        return False
+    with open(meta) as f:
+        return json.load(f).get('version') == FORMAT_VERSION
+
+def du(path):
+    return sum(os.path.getsize(os.path.join(path, name)) for name in os.listdir(path))
+
+if __name__ == '__main__':
+    p = argparse.ArgumentParser()
+    p.add_argument('-data_dir', type=str, default="../data/")
+    p.add_argument('-force', action='store_true')
+    args = p.parse_args()
+
+    for root, dirs, files in sorted(os.walk(args.data_dir)):
+        for name in sorted(files):
+            if not name.endswith('.pickle'):
+                continue
+            src = os.path.join(root, name)
+            dst = src[:-len('.pickle')] + '.mmap'
+            if up_to_date(src, dst) and not args.force:
+                print('%s: up to date' % dst)
+                continue
+            with open(src, 'rb') as handle:
+                samples = pickle.load(handle)
+            bert = is_bert(samples)
+            write_columns(samples, dst, bert)
+            with open(os.path.join(dst, 'meta.json')) as f:
+                meta = json.load(f)
+            print('%s: %d samples, %d sentences (%s), %.1fMB -> %.1fMB'
+                  % (dst, len(samples), meta['sentences'], 'bert' if bert else 'glove',
+                     os.path.getsize(src) / 2**20, du(dst) / 2**20))
@@ -1,11 +1,118 @@
 import numpy as np
-from torch.utils.data import DataLoader
+from torch.utils.data import DataLoader, Sampler
 import torch
 from torch.nn.utils.rnn import pad_sequence
 
-def get_data_loader(dataset, batch_size, shuffle=False):
+def get_data_loader(dataset, batch_size, shuffle=False, batch_sampler=None):
+    if batch_sampler is not None:
+        return DataLoader(dataset, batch_sampler=batch_sampler, collate_fn=_collate_fn, num_workers=0)
     return DataLoader(dataset, batch_size=batch_size, shuffle=shuffle, collate_fn=_collate_fn, num_workers=0, worker_init_fn=0)
 
+class DocumentBatchSampler(Sampler):
+    '''
+    Batches of all the pairs of k documents, both directions, so that every
+    batch is a set of complete document ILPs. The indices keep the dataset
+    order: forward pairs first, then the backward ones in the same order.
+    shuffle: shuffle the documents every epoch, reproducibly from seed
+    '''
+    def __init__(self, dataset, k, shuffle=False, seed=0):
+        self.docs = list(dataset.documents().values())
+        self.k = k
+        self.shuffle = shuffle
+        self.seed = seed
+        self.epoch = 0
+
+    def __iter__(self):
+        order = np.arange(len(self.docs))
+        if self.shuffle:
+            np.random.RandomState(self.seed + self.epoch).shuffle(order)
+        self.epoch += 1
+        for i in range(0, len(order), self.k):
+            yield sorted(idx for d in order[i:i + self.k] for idx in self.docs[d])
+
+    def __len__(self):
+        return (len(self.docs) + self.k - 1) // self.k
+
+class IndexedBatchSampler(Sampler):
+    '''
+    The batches of another batch sampler, keeping the last one drawn: the
+    DataLoader (num_workers=0) collates a batch right after drawing it, so
+    last holds the dataset indices of the batch it just returned.
+    '''
+    def __init__(self, batch_sampler):
+        self.batch_sampler = batch_sampler
+        self.last = None
+
+    def __iter__(self):
+        for batch in self.batch_sampler:
+            self.last = list(batch)
+            yield batch
+
+    def __len__(self):
+        return len(self.batch_sampler)
+
+class BucketBatchSampler(Sampler):
+    '''
+    Batches of samples of similar sentence length, each sorted longest first,
+    to cut the padding _collate_fn adds and the re-sorting in BiLSTM.forward.
+    The samples are shuffled and cut into pools of pool batches; each pool is
+    sorted by length and cut into batches, and the batches are shuffled,
+    reproducibly from seed (a new order every epoch).
+    tokens: if > 0, batches of at most tokens padded tokens (#samples x the
+            longest sentence) instead of batch_size samples
+    shuffle: False sorts the whole dataset by length, the same every epoch
+    '''
+    def __init__(self, lengths, batch_size, tokens=0, pool=50, shuffle=True, seed=0):
+        self.lengths = np.asarray(lengths)
+        self.batch_size = batch_size
+        self.tokens = tokens
+        self.pool = pool
+        self.shuffle = shuffle
+        self.seed = seed
+        self.epoch = 0
+
+    def batches(self, epoch):
+        n = len(self.lengths)
+        rng = np.random.RandomState(self.seed + epoch)
+        order = rng.permutation(n) if self.shuffle else np.arange(n)
+        size = self.batch_size * self.pool if self.shuffle else max(n, 1)
+        batches = []
+        for i in range(0, n, size):
+            chunk = order[i:i + size]
+            chunk = chunk[np.argsort(-self.lengths[chunk], kind='stable')]
+            start = 0
+            while start < len(chunk):
+                k = self.batch_size
+                if self.tokens > 0:
+                    k = max(1, self.tokens // max(int(self.lengths[chunk[start]]), 1))
+                batches.append(chunk[start:start + k])
+                start += k
+        if self.shuffle:
+            rng.shuffle(batches)
+        return batches
+
+    def __iter__(self):
+        batches = self.batches(self.epoch)
+        self.epoch += 1
+        for batch in batches:
+            yield batch.tolist()
+
+    def __len__(self):
+        return len(self.batches(self.epoch))
+
+    def report(self):
+        # padding ratio of the dataset order in batch_size batches, then of the buckets
+        n = len(self.lengths)
+        before = padding_ratio(self.lengths, [np.arange(i, min(i + self.batch_size, n)) for i in range(0, n, self.batch_size)])
+        batches = self.batches(self.epoch)
+        return ('bucketing: %d batches, padding %.1f%% -> %.1f%% of the tokens'
+                % (len(batches), 100 * before, 100 * padding_ratio(self.lengths, batches)))
+
+def padding_ratio(lengths, batches):
+    # share of the padded tokens that are padding
+    padded = sum(len(b) * lengths[b].max() for b in batches if len(b) > 0)
+    return 1.0 - float(lengths.sum()) / max(padded, 1)
+
 def _collate_fn(l):
     # pad data
     doc_ids = []
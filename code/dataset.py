@@ -1,27 +1,166 @@
 import torch
 from torch.utils import data
 import pickle
+import json
+import os
 import numpy as np
+from collections import OrderedDict
+from base import rev_label_ids
 
-class EventDataset(data.Dataset):
-    def __init__(self, data_dir, data_split, glove2vocab, data_dir_rev="", bert=False):
-        'Initialization'
-        self.glove2vocab = glove2vocab
-        with open(data_dir + data_split + '.pickle', 'rb') as handle:
+# integer columns of a sample, in ColumnStore.cols
+COLUMNS = ['label', 'rev', 'lidx_start', 'lidx_end', 'ridx_start', 'ridx_end', 'pred_ind']
+# bumped when the layout of write_columns changes
+FORMAT_VERSION = 2
+
+def write_columns(samples, path, bert=False):
+    '''
+    Write one split (the list of samples of a pickle) to the directory path,
+    as the memory-mapped columns ColumnStore reads. The pairs of a document
+    mostly share their sentences, which are stored once per (doc, sentence):
+        sent.npy          the distinct sentences back to back: token ids into
+                          tokens.json (glove) or the BERT features (#tokens, dim)
+        sent_offsets.npy  (#sentences + 1,) where each sentence starts in sent.npy
+        pos.npy, pos_offsets.npy  their pos tags, the same way
+        sent_ids.npy      (#samples,) int32 the sentence of each sample
+        fts.npy           (#samples, #features) float32
+        cols.npy          (#samples, len(COLUMNS)) int64
+        ids.npy           (#samples, 4) int32: doc id, sample id, left and
+                          right event, into strings.json
+    '''
+    os.makedirs(path, exist_ok=True)
+    n = len(samples)
+
+    def offsets(seqs):
+        off = np.zeros(len(seqs) + 1, dtype=np.int64)
+        off[1:] = np.cumsum([len(s) for s in seqs])
+        return off
+
+    # (doc_id, sentence, pos tags) -> sentence id
+    sentences = OrderedDict()
+    sents, pos, sent_ids = [], [], []
+    for s in samples:
+        sent = np.asarray(s[4][0][0], dtype=np.float32) if bert else s[4][0]
+        key = (s[0], sent.tobytes() if bert else tuple(sent), tuple(s[4][1]))
+        if key not in sentences:
+            sentences[key] = len(sents)
+            sents.append(sent)
+            pos.append(s[4][1])
+        sent_ids.append(sentences[key])
+    np.save(os.path.join(path, 'sent_ids.npy'), np.array(sent_ids, dtype=np.int32))
+
+    sent_offsets = offsets(sents)
+    tokens = OrderedDict()
+    if bert:
+        dim = next((s.shape[1] for s in sents if len(s) > 0), 0)
+        sent = np.lib.format.open_memmap(os.path.join(path, 'sent.npy'), mode='w+', dtype=np.float32,
+                                         shape=(int(sent_offsets[-1]), dim))
+        for i, s in enumerate(sents):
+            if len(s) > 0:
+                sent[sent_offsets[i]:sent_offsets[i + 1]] = s
+        sent.flush()
+        del sent
+    else:
+        sent = [tokens.setdefault(x, len(tokens)) for s in sents for x in s]
+        np.save(os.path.join(path, 'sent.npy'), np.array(sent, dtype=np.int32))
+    np.save(os.path.join(path, 'sent_offsets.npy'), sent_offsets)
+
+    np.save(os.path.join(path, 'pos.npy'), np.array([x for p in pos for x in p], dtype=np.int32))
+    np.save(os.path.join(path, 'pos_offsets.npy'), offsets(pos))
+    np.save(os.path.join(path, 'fts.npy'), np.array([s[4][2] for s in samples], dtype=np.float32).reshape(n, -1))
+    np.save(os.path.join(path, 'cols.npy'),
+            np.array([[s[3]] + list(s[4][3:9]) for s in samples], dtype=np.int64).reshape(n, len(COLUMNS)))
+
+    strings = OrderedDict()
+    ids = [[strings.setdefault(x, len(strings)) for x in (s[0], s[1], s[2][0], s[2][1])] for s in samples]
+    np.save(os.path.join(path, 'ids.npy'), np.array(ids, dtype=np.int32).reshape(n, 4))
+    with open(os.path.join(path, 'strings.json'), 'w') as f:
+        json.dump(list(strings), f)
+    with open(os.path.join(path, 'tokens.json'), 'w') as f:
+        json.dump(list(tokens), f)
+    # written last: a directory without it is an interrupted conversion
+    with open(os.path.join(path, 'meta.json'), 'w') as f:
+        json.dump({'version': FORMAT_VERSION, 'samples': n, 'sentences': len(sents), 'bert': bert,
+                   'columns': COLUMNS}, f)
+
+class ColumnStore():
+    '''
+    A split written by write_columns(). The arrays are memory-mapped (copy on
+    write, so torch can wrap them without copying): opening reads no samples,
+    and processes reading the same split share the pages.
+    '''
+
+    def __init__(self, path, glove2vocab=None, bert=False):
+        with open(os.path.join(path, 'meta.json')) as f:
+            meta = json.load(f)
+        if meta.get('version') != FORMAT_VERSION:
+            raise ValueError('%s was written by an older convert_data.py, run it again' % path)
+        if meta['bert'] != bert:
+            raise ValueError('%s holds %s features, run convert_data.py again'
+                             % (path, 'bert' if meta['bert'] else 'glove'))
+        load = lambda name: np.load(os.path.join(path, name + '.npy'), mmap_mode='c')
+        self.sent, self.sent_offsets = load('sent'), load('sent_offsets')
+        self.pos, self.pos_offsets = load('pos'), load('pos_offsets')
+        self.fts, self.cols, self.ids = load('fts'), load('cols'), load('ids')
+        self.sent_ids = load('sent_ids')
+        with open(os.path.join(path, 'strings.json')) as f:
+            self.strings = json.load(f)
+        self.bert = bert
+        if not bert:
+            # token id -> glove index, -1 for the tokens glove2vocab misses
+            with open(os.path.join(path, 'tokens.json')) as f:
+                self.tokens = json.load(f)
+            self.vocab = torch.LongTensor([glove2vocab.get(x, -1) for x in self.tokens])
+
+    def __len__(self):
+        return len(self.ids)
+
+    def lengths(self):
+        # sentence length of every sample
+        return np.diff(self.sent_offsets)[self.sent_ids]
+
+    def sample_id(self, idx):
+        # doc_id, sample_id
+        return self.strings[self.ids[idx, 0]], self.strings[self.ids[idx, 1]]
+
+    def __getitem__(self, idx):
+        doc, sid, left, right = (self.strings[i] for i in self.ids[idx])
+        # a view of the shared sentence, no copy per pair
+        j = self.sent_ids[idx]
+        sent = torch.from_numpy(self.sent[self.sent_offsets[j]:self.sent_offsets[j + 1]])
+        if not self.bert:
+            token_ids = sent.long()
+            sent = self.vocab[token_ids]
+            if (sent < 0).any():
+                # as the dict lookup on the pickled tokens
+                raise KeyError(self.tokens[int(token_ids[sent < 0][0])])
+        pos = torch.from_numpy(self.pos[self.pos_offsets[j]:self.pos_offsets[j + 1]]).long()
+        fts = torch.from_numpy(self.fts[idx])
+        label, rev, lidx_start_s, lidx_end_s, ridx_start_s, ridx_end_s, pred_ind = (int(x) for x in self.cols[idx])
+        return (doc, sid, (left, right), label, sent, pos, fts, bool(rev),
+                lidx_start_s, lidx_end_s, ridx_start_s, ridx_end_s, pred_ind)
+
+class PickleStore():
+    '''
+    A split as pickled: the list of samples, converted to tensors on access.
+    '''
+
+    def __init__(self, path, glove2vocab=None, bert=False):
+        with open(path, 'rb') as handle:
             self.data = pickle.load(handle)
-       
-        if data_dir_rev:
-            with open(data_dir_rev + data_split + '.pickle', 'rb') as handle:
-                data_rev = pickle.load(handle)
-            self.data += data_rev
-        self.bert = bert   
+        self.glove2vocab = glove2vocab
+        self.bert = bert
 
     def __len__(self):
-        'Denotes the total number of samples'
         return len(self.data)
 
+    def lengths(self):
+        return np.array([len(s[4][0][0]) if self.bert else len(s[4][0]) for s in self.data], dtype=np.int64)
+
+    def sample_id(self, idx):
+        # doc_id, sample_id
+        return self.data[idx][0], self.data[idx][1]
+
     def __getitem__(self, idx):
-        'Generates one sample of data'
         sample = self.data[idx]
         doc_id = sample[0]
         sample_id = sample[1]
@@ -41,5 +180,123 @@ class EventDataset(data.Dataset):
         pred_ind = sample[4][8]
         return doc_id, sample_id, pair, label, sent, pos, fts, rev, lidx_start_s, lidx_end_s, ridx_start_s, ridx_end_s, pred_ind
 
+class TensorStore():
+    '''
+    Another store converted once into packed tensors: the sentences and the
+    pos tags back to back with offsets, the features stacked. Items are views
+    into them, nothing is looked up or converted per access.
+    '''
+
+    def __init__(self, store):
+        n = len(store)
+        sents, poss, fts = [], [], []
+        # the non-tensor fields: doc_id, sample_id, pair, label / rev, indices, pred_ind
+        self.head, self.tail = [], []
+        for i in range(n):
+            sample = store[i]
+            self.head.append(sample[:4])
+            sents.append(sample[4])
+            poss.append(sample[5].long())
+            fts.append(sample[6])
+            self.tail.append(sample[7:])
+        self.sent, self.sent_offsets = self.pack(sents)
+        self.pos, self.pos_offsets = self.pack(poss)
+        self.fts = torch.stack(fts) if n > 0 else torch.zeros(0)
+
+    @staticmethod
+    def pack(seqs):
+        offsets = [0]
+        for s in seqs:
+            offsets.append(offsets[-1] + s.size(0))
+        return (torch.cat(seqs) if seqs else torch.zeros(0)), offsets
+
+    def __len__(self):
+        return len(self.head)
+
+    def lengths(self):
+        return np.diff(self.sent_offsets)
+
+    def sample_id(self, idx):
+        # doc_id, sample_id
+        return self.head[idx][:2]
+
+    def __getitem__(self, idx):
+        sent = self.sent[self.sent_offsets[idx]:self.sent_offsets[idx + 1]]
+        pos = self.pos[self.pos_offsets[idx]:self.pos_offsets[idx + 1]]
+        return self.head[idx] + (sent, pos, self.fts[idx]) + self.tail[idx]
+
+class EventDataset(data.Dataset):
+    def __init__(self, data_dir, data_split, glove2vocab, data_dir_rev="", bert=False, data_format='pickle',
+                 rev_labels=None):
+        '''
+        data_dir_rev: the backward samples of the split, if any
+        rev_labels: derive the backward samples from the forward ones instead,
+                    with the labels reversed through this table (rev_label_ids)
+        '''
+        self.glove2vocab = glove2vocab
+        self.data_format = data_format
+        self.rev_labels = rev_labels
+        if data_format == 'mmap':
+            open_store = lambda d: ColumnStore(d + data_split + '.mmap', glove2vocab, bert)
+        elif data_format == 'tensor':
+            open_store = lambda d: TensorStore(PickleStore(d + data_split + '.pickle', glove2vocab, bert))
+        else:
+            open_store = lambda d: PickleStore(d + data_split + '.pickle', glove2vocab, bert)
+        # (store, reversed): the samples are the parts one after the other
+        self.parts = [(open_store(data_dir), False)]
+        if data_dir_rev:
+            self.parts.append((open_store(data_dir_rev), False))
+        elif rev_labels is not None:
+            self.parts.append((self.parts[0][0], True))
+        self.starts = np.cumsum([0] + [len(s) for s, _ in self.parts])
+        self.bert = bert
+
+    def __len__(self):
+        'Denotes the total number of samples'
+        return int(self.starts[-1])
+
+    def __getitem__(self, idx):
+        'Generates one sample of data'
+        p = int(np.searchsorted(self.starts, idx, side='right')) - 1
+        store, reverse = self.parts[p]
+        sample = store[int(idx - self.starts[p])]
+        if reverse:
+            # the backward sample: same sentence and event indices (the model
+            # flips the rev samples), rev set and the label reversed
+            label = sample[3]
+            if sample[1][0] in self.rev_labels:
+                label = self.rev_labels[sample[1][0]][label]
+            sample = sample[:3] + (label,) + sample[4:7] + (True,) + sample[8:]
+        return sample
+
+    def sample_ids(self):
+        # (doc_id, sample_id) of every sample, without loading the features
+        return [store.sample_id(i) for store, _ in self.parts for i in range(len(store))]
+
+    def lengths(self):
+        # sentence length of every sample, for BucketBatchSampler
+        return np.concatenate([store.lengths() for store, _ in self.parts])
+
+    def documents(self):
+        # doc_id -> indices of its samples, both directions
+        docs = OrderedDict()
+        for idx, (doc_id, _) in enumerate(self.sample_ids()):
+            docs.setdefault(doc_id, []).append(idx)
+        return docs
+
     def merge_dataset(self, dataset):
-        self.data += dataset.data
+        self.parts += dataset.parts
+        self.starts = np.cumsum([0] + [len(s) for s, _ in self.parts])
+        if self.rev_labels is None:
+            self.rev_labels = dataset.rev_labels
+
+def load_split(args, data_dir, data_split, data_dir_rev=""):
+    '''
+    EventDataset of a split with the features and format of args; with
+    -derive_backward the backward samples come from the forward ones and
+    data_dir_rev is not read
+    '''
+    if data_dir_rev and args.derive_backward:
+        return EventDataset(data_dir, data_split, args.glove2vocab, "", args.bert_fts, args.data_format,
+                            rev_labels=rev_label_ids(args.data_type))
+    return EventDataset(data_dir, data_split, args.glove2vocab, data_dir_rev, args.bert_fts, args.data_format)
@@ -16,22 +16,33 @@ from torch.autograd import Variable
 import time
 import copy
 from torch.utils import data
+from torch.utils.data import BatchSampler, SequentialSampler
 from base import EveEveRelModel, matres_label_map, tbd_label_map, new_label_map, causal_label_map
 from base import  ClassificationReport, rev_map, rev_causal_map
 from featureFuncs import *
-from gurobi_inference import Gurobi_Inference
+from ilp_inference import DocumentInference, DocumentPipeline, compare_decoders
+from ilp_inference import get_solution_cache
 import multiprocessing as mp
 from functools import partial
 from sklearn.model_selection import ParameterGrid
 from temporal_evaluation import *
 from nn_model import BiLSTM
-from dataloader import get_data_loader
-from dataset import EventDataset
+from dataloader import get_data_loader, DocumentBatchSampler, IndexedBatchSampler
+from dataset import load_split
 import os
  
 torch.backends.cudnn.deterministic = True
 torch.backends.cudnn.benchmark = False
 
+def rng_state():
+    # the torch RNG state (dropout masks) of the cpu and of the gpus
+    return torch.get_rng_state(), (torch.cuda.get_rng_state_all() if torch.cuda.is_available() else None)
+
+def set_rng_state(state):
+    torch.set_rng_state(state[0])
+    if state[1] is not None:
+        torch.cuda.set_rng_state_all(state[1])
+
 @dataclass
 class Evaluator:
     model: EveEveRelModel
@@ -93,8 +104,16 @@ class NNClassifier(EveEveRelModel):
     _label_to_id_c = {}
     _id_to_label_c = {}
 
-    def predict(self, model, eval_data, args, in_dev=False):
+    def predict(self, model, eval_data, args, in_dev=False, inference=None):
         model.eval()
+        # ilp_pipeline: documents are solved while the next ones are scored
+        pipe = None
+        own_inference = False
+        if args.ilp_pipeline and (args.trainon != 'bothWselect'):
+            if inference is None:
+                inference = self.get_inference(args)
+                own_inference = True
+            pipe = DocumentPipeline(inference, expected_pairs(eval_data.dataset, args.joint))
         step = 1
         correct = 0.
         eval_pairs = []
@@ -138,6 +157,8 @@ class NNClassifier(EveEveRelModel):
                     left = pair[i][0]
                     right = pair[i][1]
                     eval_pairs.append(("%s_%s"%(doc_id[i], left), "%s_%s"%(doc_id[i], right)))
+                if pipe is not None:
+                    pipe.add(eval_pairs[-len(doc_id):], prob.cpu().data.numpy())
                 probs.append(prob)
                 gt_labels.append(label)
 
@@ -159,6 +180,8 @@ class NNClassifier(EveEveRelModel):
                     left = pair[i][0]
                     right = pair[i][1]
                     eval_pairs_r.append(("%s_%s"%(doc_id[i], right), "%s_%s"%(doc_id[i], left)))
+                if pipe is not None:
+                    pipe.add(eval_pairs_r[-len(doc_id):], prob.cpu().data.numpy(), rev=True)
                 probs_r.append(prob)
                 gt_labels_r.append(label)
                 
@@ -182,6 +205,8 @@ class NNClassifier(EveEveRelModel):
                     left = pair[i][0]
                     right = pair[i][1]
                     eval_pairs_c.append(("%s_%s"%(doc_id[i], left), "%s_%s"%(doc_id[i], right)))
+                if pipe is not None:
+                    pipe.add(eval_pairs_c[-len(doc_id):], prob.cpu().data.numpy(), causal=True)
                 probs_c.append(prob)
                 gt_labels_c.append(label)
             
@@ -205,6 +230,8 @@ class NNClassifier(EveEveRelModel):
                     left = pair[i][0]
                     right = pair[i][1]
                     eval_pairs_c_r.append(("%s_%s"%(doc_id[i], right), "%s_%s"%(doc_id[i], left)))
+                if pipe is not None:
+                    pipe.add(eval_pairs_c_r[-len(doc_id):], prob.cpu().data.numpy(), rev=True, causal=True)
                 probs_c_r.append(prob)
                 gt_labels_c_r.append(label)
         # perform global inference
@@ -254,12 +281,22 @@ class NNClassifier(EveEveRelModel):
             prob_table_c = probs_c.cpu().data.numpy()
             gt_labels_c = torch.cat(gt_labels_c+gt_labels_c_r, dim=0)
             ground_truth = torch.cat((gt_labels, gt_labels_c), dim=0)
+        if args.ilp_bench:
+            compare_decoders(eval_pairs, prob_table, eval_pairs_c, prob_table_c,
+                             self._label_to_id, self._label_to_id_c,
+                             backward=(args.trainon!='forward'), trans_only=args.trans_only,
+                             workers=args.ilp_workers, solver=args.ilp_solver)
+        labels = None
+        if pipe is not None:
+            labels = pipe.finish()
+            if own_inference:
+                inference.close()
         # find max prediction based on global prediction 
         best_pred_idx, best_pred_idx_c, predictions=\
             self.global_prediction(eval_pairs, prob_table, eval_pairs_c,
                                    prob_table_c, evaluate=True,
                                    true_labels=ground_truth, backward=(args.trainon!='forward'),
-                                   trans_only=(args.trans_only))
+                                   trans_only=(args.trans_only), inference=inference, labels=labels)
         loss = self.loss_func(best_pred_idx, gt_labels, probs, args.margin)
         print("Evaluation loss: %.4f" % loss.cpu().data.numpy())
         print("*"*50)
@@ -308,158 +345,203 @@ class NNClassifier(EveEveRelModel):
         else:
             raise ValueError('the choice of optimizer did not exist')
         early_stop_counter = 0 
+        # one solver for the whole run: with -ilp_cache the per-document
+        # models are kept across epochs and only their objective changes
+        inference = self.get_inference(args, cache=args.ilp_cache)
+        if args.ilp_pipeline:
+            expected = expected_pairs(train_data.dataset, args.joint)
         for epoch in range(args.epochs):
             if not in_cv:
                 print('Training... %s-th epoch'%(epoch+1)) 
             model.train()
             correct = 0.
-            step = 1    
-            train_pairs = []
-            train_pairs_r = []
-            train_pairs_c = []
-            train_pairs_c_r = []
-            probs, probs_r, probs_c, probs_c_r = [], [], [], []
-            gt_labels, gt_labels_r, gt_labels_c, gt_labels_c_r = [], [], [], []
-            start_time = time.time()
-            model.zero_grad()       
-            for data in train_data:
-                seq_lens,data_id,(doc_ids,pairs),labels,sents,poss,fts,revs,lidx_start,lidx_end,ridx_start,ridx_end,_ = togpu_data(data)
-                idx_u = []
-                idx_u_r = []
-                idx_c = []
-                idx_c_r = []
-                idx_l = []
-                idx_l_r = []
-                for i, ids in enumerate(data_id):
-                    if ids[0] == 'C':
-                        if revs[i]:
-                            idx_c_r.append(i)
-                        else:
-                            idx_c.append(i)
-                    elif ids[0] == 'L':
-                        if revs[i]:
-                            idx_l_r.append(i)
-                        else:
-                            idx_l.append(i)
-                if len(idx_l) > 0:
-                    seq_l = seq_lens[idx_l]
-                    sent = sents[idx_l]
-                    pos = poss[idx_l]
-                    ft = fts[idx_l]
-                    l_start = lidx_start[idx_l]
-                    l_end = lidx_end[idx_l]
-                    r_start = ridx_start[idx_l]
-                    r_end = ridx_end[idx_l]
-                    out, prob = model(seq_l, (sent, pos, ft), l_start, l_end, 
-                                      r_start, r_end, flip=False, causal=False)
-                    label = labels[idx_l]
-                    doc_id = [doc_ids[i] for i in idx_l]
-                    pair = [pairs[i] for i in idx_l]
-                    for i in range(len(doc_id)):
-                        left = pair[i][0]
-                        right = pair[i][1]
-                        train_pairs.append(("%s_%s"%(doc_id[i], left), "%s_%s"%(doc_id[i], right)))
-                    probs.append(prob)
-                    gt_labels.append(label)
-
-                if len(idx_l_r) > 0:
-                    seq_l = seq_lens[idx_l_r]
-                    sent = sents[idx_l_r]
-                    pos = poss[idx_l_r]
-                    ft = fts[idx_l_r]
-                    l_start = lidx_start[idx_l_r]
-                    l_end = lidx_end[idx_l_r]
-                    r_start = ridx_start[idx_l_r]
-                    r_end = ridx_end[idx_l_r]
-                    out, prob = model(seq_l, (sent, pos, ft), l_start, l_end, 
-                                      r_start, r_end, flip=True, causal=False)
-                    label = labels[idx_l_r]
-                    doc_id = [doc_ids[i] for i in idx_l_r]
-                    pair = [pairs[i] for i in idx_l_r]
-                    for i in range(len(doc_id)):
-                        left = pair[i][0]
-                        right = pair[i][1]
-                        train_pairs_r.append(("%s_%s"%(doc_id[i], right), "%s_%s"%(doc_id[i], left)))
-                    probs_r.append(prob)
-                    gt_labels_r.append(label)
+            losses = []
+            active = Counter() # two_phase: active / all pairs of the epoch
+            for step_data in self.train_steps(train_data, args):
+                step = 1    
+                train_pairs = []
+                train_pairs_r = []
+                train_pairs_c = []
+                train_pairs_c_r = []
+                probs, probs_r, probs_c, probs_c_r = [], [], [], []
+                gt_labels, gt_labels_r, gt_labels_c, gt_labels_c_r = [], [], [], []
+                start_time = time.time()
+                model.zero_grad()       
+                # two_phase: score without autograd, keep every forward call
+                # and the (call, row) of every score to recompute the active ones
+                calls = []
+                refs, refs_r, refs_c, refs_c_r = [], [], [], []
+                pipe = DocumentPipeline(inference, expected) if args.ilp_pipeline else None
+                torch.set_grad_enabled(not args.two_phase)
+                for indices, data in step_data:
+                    seq_lens,data_id,(doc_ids,pairs),labels,sents,poss,fts,revs,lidx_start,lidx_end,ridx_start,ridx_end,_ = togpu_data(data)
+                    idx_u = []
+                    idx_u_r = []
+                    idx_c = []
+                    idx_c_r = []
+                    idx_l = []
+                    idx_l_r = []
+                    for i, ids in enumerate(data_id):
+                        if ids[0] == 'C':
+                            if revs[i]:
+                                idx_c_r.append(i)
+                            else:
+                                idx_c.append(i)
+                        elif ids[0] == 'L':
+                            if revs[i]:
+                                idx_l_r.append(i)
+                            else:
+                                idx_l.append(i)
+                    if len(idx_l) > 0:
+                        seq_l = seq_lens[idx_l]
+                        sent = sents[idx_l]
+                        pos = poss[idx_l]
+                        ft = fts[idx_l]
+                        l_start = lidx_start[idx_l]
+                        l_end = lidx_end[idx_l]
+                        r_start = ridx_start[idx_l]
+                        r_end = ridx_end[idx_l]
+                        refs.extend(self.record_call(calls, indices, idx_l, False, False, args))
+                        out, prob = model(seq_l, (sent, pos, ft), l_start, l_end, 
+                                          r_start, r_end, flip=False, causal=False)
+                        label = labels[idx_l]
+                        doc_id = [doc_ids[i] for i in idx_l]
+                        pair = [pairs[i] for i in idx_l]
+                        for i in range(len(doc_id)):
+                            left = pair[i][0]
+                            right = pair[i][1]
+                            train_pairs.append(("%s_%s"%(doc_id[i], left), "%s_%s"%(doc_id[i], right)))
+                        if pipe is not None:
+                            pipe.add(train_pairs[-len(doc_id):], prob.cpu().data.numpy())
+                        probs.append(prob)
+                        gt_labels.append(label)
+
+                    if len(idx_l_r) > 0:
+                        seq_l = seq_lens[idx_l_r]
+                        sent = sents[idx_l_r]
+                        pos = poss[idx_l_r]
+                        ft = fts[idx_l_r]
+                        l_start = lidx_start[idx_l_r]
+                        l_end = lidx_end[idx_l_r]
+                        r_start = ridx_start[idx_l_r]
+                        r_end = ridx_end[idx_l_r]
+                        refs_r.extend(self.record_call(calls, indices, idx_l_r, True, False, args))
+                        out, prob = model(seq_l, (sent, pos, ft), l_start, l_end, 
+                                          r_start, r_end, flip=True, causal=False)
+                        label = labels[idx_l_r]
+                        doc_id = [doc_ids[i] for i in idx_l_r]
+                        pair = [pairs[i] for i in idx_l_r]
+                        for i in range(len(doc_id)):
+                            left = pair[i][0]
+                            right = pair[i][1]
+                            train_pairs_r.append(("%s_%s"%(doc_id[i], right), "%s_%s"%(doc_id[i], left)))
+                        if pipe is not None:
+                            pipe.add(train_pairs_r[-len(doc_id):], prob.cpu().data.numpy(), rev=True)
+                        probs_r.append(prob)
+                        gt_labels_r.append(label)
                     
-                if (len(idx_c) > 0) and args.joint:
-                    seq_l = seq_lens[idx_c]
-                    sent = sents[idx_c]
-                    pos = poss[idx_c]
-                    ft = fts[idx_c]
-                    l_start = lidx_start[idx_c]
-                    l_end = lidx_end[idx_c]
-                    r_start = ridx_start[idx_c]
-                    r_end = ridx_end[idx_c]
-                    out, prob = model(seq_l, (sent, pos, ft), l_start, l_end, 
-                                      r_start, r_end, flip=False, causal=True)
-                    label = labels[idx_c]
-                    predicted = (prob.data.max(1)[1]).long().view(-1)
-                    correct += (predicted == label.data).sum()
-                    doc_id = [doc_ids[i] for i in idx_c]
-                    pair = [pairs[i] for i in idx_c]
-                    for i in range(len(doc_id)):
-                        left = pair[i][0]
-                        right = pair[i][1]
-                        train_pairs_c.append(("%s_%s"%(doc_id[i], left), "%s_%s"%(doc_id[i], right)))
-                    probs_c.append(prob)
-                    gt_labels_c.append(label)
+                    if (len(idx_c) > 0) and args.joint:
+                        seq_l = seq_lens[idx_c]
+                        sent = sents[idx_c]
+                        pos = poss[idx_c]
+                        ft = fts[idx_c]
+                        l_start = lidx_start[idx_c]
+                        l_end = lidx_end[idx_c]
+                        r_start = ridx_start[idx_c]
+                        r_end = ridx_end[idx_c]
+                        refs_c.extend(self.record_call(calls, indices, idx_c, False, True, args))
+                        out, prob = model(seq_l, (sent, pos, ft), l_start, l_end, 
+                                          r_start, r_end, flip=False, causal=True)
+                        label = labels[idx_c]
+                        predicted = (prob.data.max(1)[1]).long().view(-1)
+                        correct += (predicted == label.data).sum()
+                        doc_id = [doc_ids[i] for i in idx_c]
+                        pair = [pairs[i] for i in idx_c]
+                        for i in range(len(doc_id)):
+                            left = pair[i][0]
+                            right = pair[i][1]
+                            train_pairs_c.append(("%s_%s"%(doc_id[i], left), "%s_%s"%(doc_id[i], right)))
+                        if pipe is not None:
+                            pipe.add(train_pairs_c[-len(doc_id):], prob.cpu().data.numpy(), causal=True)
+                        probs_c.append(prob)
+                        gt_labels_c.append(label)
                 
-                if (len(idx_c_r) > 0) and args.joint:
-                    seq_l = seq_lens[idx_c_r]
-                    sent = sents[idx_c_r]
-                    pos = poss[idx_c_r]
-                    ft = fts[idx_c_r]
-                    l_start = lidx_start[idx_c_r]
-                    l_end = lidx_end[idx_c_r]
-                    r_start = ridx_start[idx_c_r]
-                    r_end = ridx_end[idx_c_r]
-                    out, prob = model(seq_l, (sent, pos, ft), l_start, l_end, 
-                                      r_start, r_end, flip=True, causal=True)
-                    label = labels[idx_c_r]
-                    predicted = (prob.data.max(1)[1]).long().view(-1)
-                    correct += (predicted == label.data).sum()
-                    doc_id = [doc_ids[i] for i in idx_c_r]
-                    pair = [pairs[i] for i in idx_c_r]
-                    for i in range(len(doc_id)):
-                        left = pair[i][0]
-                        right = pair[i][1]
-                        train_pairs_c_r.append(("%s_%s"%(doc_id[i], right), "%s_%s"%(doc_id[i], left)))
-                    probs_c_r.append(prob)
-                    gt_labels_c_r.append(label)
-                step += 1 
-            # perform global inference
-            # concat all data first
-            train_pairs = train_pairs+train_pairs_r
-            train_pairs_c = train_pairs_c+train_pairs_c_r
-            probs = torch.cat((probs+probs_r), dim=0)
-            prob_table = probs.cpu().data.numpy()
-            gt_labels = torch.cat(gt_labels+gt_labels_r, dim=0)
-            prob_table_c = np.zeros((0, 0))
-            if len(probs_c) > 0:
-                probs_c = torch.cat((probs_c+probs_c_r), dim=0)
-                prob_table_c = probs_c.cpu().data.numpy()
-                gt_labels_c = torch.cat(gt_labels_c+gt_labels_c_r, dim=0)
+                    if (len(idx_c_r) > 0) and args.joint:
+                        seq_l = seq_lens[idx_c_r]
+                        sent = sents[idx_c_r]
+                        pos = poss[idx_c_r]
+                        ft = fts[idx_c_r]
+                        l_start = lidx_start[idx_c_r]
+                        l_end = lidx_end[idx_c_r]
+                        r_start = ridx_start[idx_c_r]
+                        r_end = ridx_end[idx_c_r]
+                        refs_c_r.extend(self.record_call(calls, indices, idx_c_r, True, True, args))
+                        out, prob = model(seq_l, (sent, pos, ft), l_start, l_end, 
+                                          r_start, r_end, flip=True, causal=True)
+                        label = labels[idx_c_r]
+                        predicted = (prob.data.max(1)[1]).long().view(-1)
+                        correct += (predicted == label.data).sum()
+                        doc_id = [doc_ids[i] for i in idx_c_r]
+                        pair = [pairs[i] for i in idx_c_r]
+                        for i in range(len(doc_id)):
+                            left = pair[i][0]
+                            right = pair[i][1]
+                            train_pairs_c_r.append(("%s_%s"%(doc_id[i], right), "%s_%s"%(doc_id[i], left)))
+                        if pipe is not None:
+                            pipe.add(train_pairs_c_r[-len(doc_id):], prob.cpu().data.numpy(), rev=True, causal=True)
+                        probs_c_r.append(prob)
+                        gt_labels_c_r.append(label)
+                    step += 1 
+                torch.set_grad_enabled(True)
+                # perform global inference
+                # concat all data first
+                train_pairs = train_pairs+train_pairs_r
+                train_pairs_c = train_pairs_c+train_pairs_c_r
+                probs = torch.cat((probs+probs_r), dim=0)
+                prob_table = probs.cpu().data.numpy()
+                gt_labels = torch.cat(gt_labels+gt_labels_r, dim=0)
+                prob_table_c = np.zeros((0, 0))
+                if len(probs_c) > 0:
+                    probs_c = torch.cat((probs_c+probs_c_r), dim=0)
+                    prob_table_c = probs_c.cpu().data.numpy()
+                    gt_labels_c = torch.cat(gt_labels_c+gt_labels_c_r, dim=0)
             
-            # find max prediction based on global prediction 
-            best_pred_idx, best_pred_idx_c =\
-                self.global_prediction(train_pairs, prob_table, train_pairs_c,
-                                       prob_table_c, backward=(args.trainon!='forward'),
-                                       trans_only=(args.trans_only))
+                # find max prediction based on global prediction 
+                best_pred_idx, best_pred_idx_c =\
+                    self.global_prediction(train_pairs, prob_table, train_pairs_c,
+                                           prob_table_c, backward=(args.trainon!='forward'),
+                                           trans_only=(args.trans_only), inference=inference,
+                                           verbose=(args.doc_batch == 0),
+                                           labels=pipe.finish(args.doc_batch == 0) if pipe is not None else None)
             
-            loss = self.loss_func(best_pred_idx, gt_labels, probs, args.margin)
-            if len(probs_c) > 0:
-                loss_c = self.loss_func(best_pred_idx_c, gt_labels_c, probs_c, args.margin)
-                loss = loss + loss_c
-            loss.backward()
-            torch.nn.utils.clip_grad_norm_(model.parameters(), 5)
-            optimizer.step()                               
+                if args.two_phase:
+                    # phase 2: backward only through the pairs with a non-zero loss
+                    loss_t = self.hinge_loss(best_pred_idx, gt_labels, probs, args.margin)
+                    loss = torch.mean(loss_t)
+                    active['temporal'] += self.active_backward(model, train_data, calls, refs+refs_r,
+                                                               best_pred_idx, gt_labels, loss_t, args)
+                    active['temporal pairs'] += len(refs+refs_r)
+                    if len(probs_c) > 0:
+                        loss_c = self.hinge_loss(best_pred_idx_c, gt_labels_c, probs_c, args.margin)
+                        loss = loss + torch.mean(loss_c)
+                        active['causal'] += self.active_backward(model, train_data, calls, refs_c+refs_c_r,
+                                                                 best_pred_idx_c, gt_labels_c, loss_c, args)
+                        active['causal pairs'] += len(refs_c+refs_c_r)
+                else:
+                    loss = self.loss_func(best_pred_idx, gt_labels, probs, args.margin,
+                                          best_pred_idx_c, gt_labels_c, probs_c)
+                    loss.backward()
+                torch.nn.utils.clip_grad_norm_(model.parameters(), 5)
+                optimizer.step()                               
+                losses.append(loss.cpu().item())
             if not in_cv:
-                print("Train loss: %.4f" % loss.cpu().item())
+                print("Train loss: %.4f" % np.mean(losses))
+                for kind in ('temporal', 'causal'):
+                    if active[kind + ' pairs'] > 0:
+                        print("Active %s pairs: %s of %s" % (kind, active[kind], active[kind + ' pairs']))
             ###### Evaluate at the end of each epoch ##### 
             if len(eval_data) > 0:
-                eval_gt, eval_preds = self.predict(model, eval_data, args, in_dev=True)
+                eval_gt, eval_preds = self.predict(model, eval_data, args, in_dev=True, inference=inference)
                 eval_f1 = self.weighted_f1(eval_preds, eval_gt)
                 #ta_f1 = temporal_awareness(eval_data, [self._id_to_label[x] for x in eval_preds])
                 if eval_f1 > best_eval_f1:
@@ -476,6 +558,7 @@ class NNClassifier(EveEveRelModel):
                     early_stop_counter += 1
                 print("Evaluation F1: %.4f" % eval_f1)
                 print("*"*50)
+        inference.close()
         print("Final Evaluation F1: %.4f" % best_eval_f1)
         print("*"*50)
         if len(eval_data) == 0 or (args.epochs==0):
@@ -492,64 +575,148 @@ class NNClassifier(EveEveRelModel):
         
         return best_eval_f1, best_epoch
     
-    def loss_func(self, best_pred_idx, gt_labels, probs, margin):
-        mask_pred = togpu(torch.ByteTensor(best_pred_idx))
-        assert mask_pred.size() == probs.size()
-        max_scores = torch.masked_select(probs, mask_pred) # S(y^;x) ; 1D array
-        # true label scores
-        N = probs.size()[0]
-        C = probs.size()[1]
-        assert max_scores.size(0) == N
-        idx_mat = np.zeros((N, C), dtype=int)
-        for n in range(N):
-            idx_mat[n][gt_labels[n]] = 1
-        mask = togpu(torch.ByteTensor(idx_mat))
-        assert mask.size() == probs.size()
-        label_scores = torch.masked_select(probs, mask) # S(y;x) ; 1D array
+    def train_steps(self, train_data, args):
+        # the (dataset indices, batch) of every optimizer step: with doc_batch
+        # every batch (k documents, see DocumentBatchSampler) is a step,
+        # otherwise the whole corpus is one step
+        batches = self.indexed_batches(train_data)
+        if args.doc_batch > 0:
+            for batch in batches:
+                yield [batch]
+        else:
+            yield batches
+
+    def indexed_batches(self, loader):
+        # the batches of the DataLoader (see get_train_loader), with the
+        # dataset indices of their rows
+        for data in loader:
+            yield loader.batch_sampler.last, data
+
+    def loss_func(self, best_pred_idx, gt_labels, probs, margin,
+                  best_pred_idx_c=None, gt_labels_c=None, probs_c=None):
+        # mean hinge loss of the temporal table, plus the one of the causal
+        # table if given
+        loss = torch.mean(self.hinge_loss(best_pred_idx, gt_labels, probs, margin))
+        if (probs_c is not None) and (len(probs_c) > 0):
+            loss = loss + torch.mean(self.hinge_loss(best_pred_idx_c, gt_labels_c, probs_c, margin))
+        return loss
+
+    def hinge_loss(self, best_pred_idx, gt_labels, probs, margin):
+        # per pair structured hinge loss, 0 where the margin holds
+        # best_pred_idx: one-hot global assignment (N, C)
+        assert best_pred_idx.shape == probs.size()
+        pred = torch.from_numpy(np.asarray(best_pred_idx).argmax(axis=1)).to(probs.device)
+        gold = gt_labels.view(-1).to(probs.device)
+        max_scores = probs.gather(1, pred.view(-1, 1)).view(-1) # S(y^;x) ; 1D array
+        label_scores = probs.gather(1, gold.view(-1, 1)).view(-1) # S(y;x) ; 1D array
         if margin == 0.0:
-            # Hammming distance
-            delta = torch.sum((mask_pred!=mask), dim=1, dtype=torch.float)
+            # Hammming distance between the one-hot assignments
+            delta = 2.0 * (pred != gold).float()
         else:
-            delta = togpu(torch.FloatTensor([margin for n in range(N)]))
+            delta = torch.full_like(max_scores, margin)
         diff = 0.1*delta + (max_scores - label_scores) # size N
-        mask = (diff<0.0)
-        loss_t = diff.masked_fill_(mask, 0.0)
-        losses = torch.mean(loss_t)
-        return losses
-    
+        return torch.clamp(diff, min=0.0)
+
+    def record_call(self, calls, indices, idx, flip, causal, args):
+        # two_phase: keep what phase 2 needs to run this forward call again
+        # with the same dropout masks: the batch (dataset indices), its rows
+        # idx and the RNG state before the call
+        # return: the (call, row) of its scores
+        calls.append((indices, idx, flip, causal, rng_state() if args.two_phase else None))
+        return [(len(calls) - 1, k) for k in range(len(idx))]
+
+    def active_backward(self, model, loader, calls, refs, best_pred_idx, gt_labels, loss_t, args):
+        '''
+        Second phase of two_phase training: run again with autograd the
+        forward calls of phase 1 that scored a pair with a hinge loss > 0,
+        each on its batch collated again from loader.dataset and with its
+        RNG state, so the dropout masks are the ones of phase 1, and
+        accumulate the gradient of the mean loss over all the pairs through
+        those pairs. Calls are backpropagated together until they hold
+        args.grad_batch rows. The RNG is left as phase 1 left it.
+        refs: (call, row) of every row of best_pred_idx, see record_call
+        return: the # of active pairs
+        '''
+        N = len(refs)
+        active = np.flatnonzero(loss_t.cpu().data.numpy() > 0)
+        groups = OrderedDict() # call -> (its rows, the rows of best_pred_idx)
+        for n in active:
+            rows, table_rows = groups.setdefault(refs[n][0], ([], []))
+            rows.append(refs[n][1])
+            table_rows.append(n)
+        state = rng_state()
+        losses, size = [], 0
+        for c, (rows, table_rows) in groups.items():
+            indices, idx, flip, causal, rng = calls[c]
+            data = loader.collate_fn([loader.dataset[i] for i in indices])
+            seq_lens,_,_,_,sents,poss,fts,_,lidx_start,lidx_end,ridx_start,ridx_end,_ = togpu_data(data)
+            set_rng_state(rng)
+            out, prob = model(seq_lens[idx], (sents[idx], poss[idx], fts[idx]), lidx_start[idx], lidx_end[idx],
+                              ridx_start[idx], ridx_end[idx], flip=flip, causal=causal)
+            losses.append(torch.sum(self.hinge_loss(best_pred_idx[table_rows], gt_labels[table_rows],
+                                                    prob[rows], args.margin)) / N)
+            size += len(idx)
+            if size >= args.grad_batch:
+                sum(losses).backward()
+                losses, size = [], 0
+        if len(losses) > 0:
+            sum(losses).backward()
+        set_rng_state(state)
+        return len(active)
+
+    def get_inference(self, args, cache=False, backward=None, trans_only=None):
+        # the DocumentInference of args; backward / trans_only override args
+        if backward is None:
+            backward = (args.trainon!='forward')
+        if trans_only is None:
+            trans_only = args.trans_only
+        return DocumentInference(self._label_to_id, self._label_to_id_c,
+                                 backward=backward, trans_only=trans_only,
+                                 workers=args.ilp_workers, solver=args.ilp_solver,
+                                 decoder=args.ilp_decoder, cache=cache,
+                                 check=args.ilp_check, warm_start=args.ilp_warm_start,
+                                 solution_cache=get_solution_cache(args.ilp_solution_cache, args.ilp_quantum),
+                                 lazy=args.ilp_lazy, fix=args.ilp_fix, prune=args.ilp_prune,
+                                 threads=args.ilp_threads, time_limit=args.ilp_time_limit,
+                                 mip_gap=args.ilp_gap, dump_dir=args.ilp_dump)
+
     def global_prediction(self, pairs, prob_table, pairs_c, prob_table_c, 
-                          evaluate=False, true_labels=[], backward=True, trans_only=False):
+                          evaluate=False, true_labels=[], backward=True, trans_only=False,
+                          inference=None, verbose=True, labels=None):
         # input:                                            
         # 1. pairs: doc_id + entity_id     
         # 2. prob_table: numpy matrix of local predictions (N * C)
         # 3. evaluate: True - print classification report
         # 4. true_label: if evaluate is true, need to true_label to evaluate model
+        # 5. inference: a DocumentInference kept by the caller; a one-off solver if None
+        # 6. verbose: print the solver summary
+        # 7. labels: (temporal, causal) labels already solved, e.g. by a DocumentPipeline
         # output:                                      
         # 1. if evaluate, print classification report and return best global assignment  
         # 2. else, class selection for each sample store in matrix form                   
         N, C = prob_table.shape
         Nc, Cc = prob_table_c.shape
-        global_model = Gurobi_Inference(pairs, prob_table, pairs_c, prob_table_c, 
-                                        self._label_to_id, self._label_to_id_c, 
-                                        backward=backward, trans_only=trans_only)
-        global_model.run()
-        global_model.predict()
+        if labels is not None:
+            pred_labels, pred_labels_c = labels
+        elif inference is None:
+            # one-off, with the same configuration as every other solve
+            inference = self.get_inference(self.args, backward=backward, trans_only=trans_only)
+            try:
+                pred_labels, pred_labels_c = inference(pairs, prob_table, pairs_c, prob_table_c, verbose=verbose)
+            finally:
+                inference.close()
+        else:
+            pred_labels, pred_labels_c = inference(pairs, prob_table, pairs_c, prob_table_c, verbose=verbose)
         best_pred_idx = np.zeros((N, C), dtype=int)
         best_pred_idx_c = np.zeros((Nc, Cc), dtype=int)
         # temporal
-        for n in range(N):
-            best_pred_idx[n, global_model.pred_labels[n]] = 1
+        best_pred_idx[np.arange(N), pred_labels] = 1
         # causal
-        for n in range(Nc):
-            best_pred_idx_c[n, global_model.pred_labels_c[n]] = 1
+        best_pred_idx_c[np.arange(Nc), pred_labels_c] = 1
         
         if evaluate:
             assert len(true_labels) == N + Nc
-            if self.args.data_type == 'tbd': 
-                prediction = global_model.evaluate(true_labels, exclude_vague=False)
-            else:
-                prediction = global_model.evaluate(true_labels, exclude_vague=True)
-            prediction = togpu(torch.LongTensor(prediction))
+            prediction = togpu(torch.LongTensor(pred_labels))
             return best_pred_idx, best_pred_idx_c, prediction
         else:
             return best_pred_idx, best_pred_idx_c
@@ -643,11 +810,9 @@ class NNClassifier(EveEveRelModel):
             else:
                 backward_dir = args.data_dir + "all_backward/"
 
-        train_data = EventDataset(args.data_dir+type_dir,"train",
-                                  args.glove2vocab, backward_dir, args.bert_fts)
-        train_generator = get_data_loader(train_data, **params)
-        dev_data = EventDataset(args.data_dir+type_dir,"dev",
-                                args.glove2vocab, backward_dir, args.bert_fts)
+        train_data = load_split(args, args.data_dir+type_dir, "train", backward_dir)
+        train_generator = get_train_loader(train_data, args)
+        dev_data = load_split(args, args.data_dir+type_dir, "dev", backward_dir)
         dev_generator = get_data_loader(dev_data, **params)
         seeds = [0, 10, 20]
         accumu_f1 = 0.
@@ -675,12 +840,10 @@ class NNClassifier(EveEveRelModel):
                 backward_dir = "%scv_backward_bertemb/fold%s/" % (args.data_dir, split)
             else:
                 backward_dir = "%scv_backward/fold%s/" % (args.data_dir, split)
-        train_data = EventDataset(args.data_dir+'%s/fold%s/'%(type_dir,split),"train",
-                                  args.glove2vocab,backward_dir,args.bert_fts)
-        train_generator = get_data_loader(train_data, **params)
+        train_data = load_split(args, args.data_dir+'%s/fold%s/'%(type_dir,split), "train", backward_dir)
+        train_generator = get_train_loader(train_data, args)
 
-        dev_data = EventDataset(args.data_dir+'%s/fold%s/'%(type_dir, split),"dev",
-                                args.glove2vocab,backward_dir,args.bert_fts)
+        dev_data = load_split(args, args.data_dir+'%s/fold%s/'%(type_dir, split), "dev", backward_dir)
         dev_generator = get_data_loader(dev_data, **params)
         seeds = [0, 10, 20]
         accumu_f1 = 0.
@@ -768,10 +931,10 @@ class NNClassifier(EveEveRelModel):
                     data_dir_back = args.data_dir + "all_backward_bertemb/"
                 else:
                     data_dir_back = args.data_dir + "all_backward/"
-            t_data = EventDataset(args.data_dir+type_dir,'train',args.glove2vocab,data_dir_back,args.bert_fts)
-            d_data = EventDataset(args.data_dir+type_dir,'dev',args.glove2vocab,data_dir_back,args.bert_fts)
+            t_data = load_split(args, args.data_dir+type_dir, 'train', data_dir_back)
+            d_data = load_split(args, args.data_dir+type_dir, 'dev', data_dir_back)
             t_data.merge_dataset(d_data)
-            train_data = get_data_loader(t_data, **params)
+            train_data = get_train_loader(t_data, args)
             dev_data = []
         best_f1, best_epoch = self._train(train_data, dev_data, emb, pos_emb, args)
         print("Final Epoch Use: %s" % best_epoch)
@@ -858,6 +1021,28 @@ def temporal_awareness(data, pred_labels, data_type, with_timex=False):
         '''
     return evaluate_all(gold_rels, pred_rels)
 
+def expected_pairs(dataset, joint):
+    # doc_id -> (#temporal, #causal) samples the global stage scores
+    counts = OrderedDict()
+    for doc_id, sample_id in dataset.sample_ids():
+        n, n_c = counts.get(doc_id, (0, 0))
+        if sample_id[0] == 'L':
+            n += 1
+        elif (sample_id[0] == 'C') and joint:
+            n_c += 1
+        counts[doc_id] = (n, n_c)
+    return counts
+
+def get_train_loader(dataset, args):
+    # with doc_batch, each batch (and optimizer step) holds all the pairs of
+    # doc_batch documents; the sampler keeps the dataset indices of the
+    # batch, see NNClassifier.train_steps
+    if args.doc_batch > 0:
+        sampler = DocumentBatchSampler(dataset, args.doc_batch, shuffle=True, seed=args.seed)
+    else:
+        sampler = BatchSampler(SequentialSampler(dataset), args.batch, drop_last=False)
+    return get_data_loader(dataset, args.batch, batch_sampler=IndexedBatchSampler(sampler))
+
 def main_global(args):
     data_dir = args.data_dir
     params = {'batch_size': args.batch,
@@ -872,12 +1057,10 @@ def main_global(args):
             data_dir_back = args.data_dir + "all_backward_bertemb/"
         else:
             data_dir_back = args.data_dir + "all_backward/"
-    train_data = EventDataset(args.data_dir + type_dir, "train", 
-                              args.glove2vocab, data_dir_back, args.bert_fts)
+    train_data = load_split(args, args.data_dir + type_dir, "train", data_dir_back)
     print('train_data: %s in total' % len(train_data))
-    train_generator = get_data_loader(train_data, **params)
-    dev_data = EventDataset(args.data_dir + type_dir, "dev", 
-                            args.glove2vocab, data_dir_back, args.bert_fts)
+    train_generator = get_train_loader(train_data, args)
+    dev_data = load_split(args, args.data_dir + type_dir, "dev", data_dir_back)
     print('dev_data: %s in total' % len(dev_data))
     dev_generator = get_data_loader(dev_data, **params)
     
@@ -885,8 +1068,7 @@ def main_global(args):
         data_dir_back = args.data_dir + "all_backward_bertemb/"
     else:
         data_dir_back = args.data_dir + "all_backward/"
-    test_data = EventDataset(args.data_dir + type_dir, "test", 
-                             args.glove2vocab, data_dir_back, args.bert_fts)
+    test_data = load_split(args, args.data_dir + type_dir, "test", data_dir_back)
     test_generator = get_data_loader(test_data, **params)
     
     s_time = time.time() 
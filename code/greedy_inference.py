@@ -0,0 +1,210 @@
+import numpy as np
+from scipy.optimize import milp, LinearConstraint, Bounds
+from ilp_inference import ILP_Inference, get_solver
+
+class Greedy_Inference(ILP_Inference):
+    '''
+    Approximate global inference without a MIP solver: pairs are labelled one
+    by one in order of confidence, every label is propagated to the domains
+    of the pairs it composes with (closure over the transitivity triples and
+    the symmetry), so later pairs only pick labels consistent with the
+    earlier ones. Causal pairs follow the temporal labels.
+    exact: solver ('gurobi' / 'highs') for documents where the propagation
+           runs into a dead end; None keeps the greedy labels
+    '''
+
+    def __init__(self, pairs, probs, pairs_c, probs_c, label2idx, label2idx_c, backward=True, trans_only=False,
+                 exact=None, **kwargs):
+        super().__init__(pairs, probs, pairs_c, probs_c, label2idx, label2idx_c,
+                         backward=backward, trans_only=trans_only, **kwargs)
+        self.lazy = False # nothing to cut, decode() is consistent by construction
+        self.exact = exact
+        self.kwargs = kwargs
+        self.triples_of = None
+
+    def build(self):
+        if self.trans_triples is None:
+            self.trans_triples = self.transitivity_list()
+        self.triples_of = [[] for n in range(self.N)]
+        for t, triple in enumerate(self.trans_triples):
+            for n in triple:
+                self.triples_of[n].append(t)
+
+    def set_objective(self):
+        # the scores are read by optimize()
+        pass
+
+    def add_transitivity(self, trans_triples):
+        pass
+
+    def scores(self):
+        # per variable score to order and pick labels by
+        return self.objective_vector()
+
+    def optimize(self):
+        scores = self.scores()
+        x = self.decode(scores)
+        if x is None:
+            self.stats['greedy_conflicts'] += 1
+            if self.exact is None:
+                x = self.decode(scores, force=True)
+            else:
+                model = get_solver(self.exact)(self.pairs, self.probs, self.pairs_c, self.probs_c,
+                                               self.label2idx, self.label2idx_c, backward=self.backward,
+                                               trans_only=self.trans_only, **self.kwargs)
+                model.run()
+                x = model.solution
+                if x is None:
+                    return None
+        self.solution = x
+        self.obj_val = float(self.objective_vector().dot(self.solution))
+        return self.solution[:self.N * self.P].reshape(self.N, self.P).argmax(axis=1)
+
+    def partner(self, n, N):
+        # the other direction of pair n, if symmetry is enforced
+        if (not self.backward) or (self.trans_only):
+            return None
+        half = int(N / 2)
+        return n + half if n < half else n - half
+
+    def propagate(self, domain, queue):
+        '''
+        Composition closure: shrink the label domains until every label left
+        of a pair has support in each of its triples (and in its reversed
+        pair), starting from the pairs in queue.
+        return: new domains (N, P), None if a domain runs empty
+        '''
+        domain = domain.copy()
+        allowed = self.allowed()
+        rev_idx = self.rev_index()[0]
+        queue = list(queue)
+        while queue:
+            q = queue.pop()
+            changed = []
+            for t in self.triples_of[q]:
+                a, b, c = self.trans_triples[t]
+                sub = allowed & domain[a][:, None, None] & domain[b][None, :, None] & domain[c][None, None, :]
+                for m, d in ((a, sub.any(axis=(1, 2))), (b, sub.any(axis=(0, 2))), (c, sub.any(axis=(0, 1)))):
+                    if (d != domain[m]).any():
+                        domain[m] = d
+                        changed.append(m)
+            p = self.partner(q, self.N)
+            if (p is not None) and (domain[p] & domain[q][rev_idx] != domain[p]).any():
+                domain[p] &= domain[q][rev_idx]
+                changed.append(p)
+            for m in changed:
+                if not domain[m].any():
+                    return None
+                queue.append(m)
+        return domain
+
+    def decode(self, scores, force=False):
+        '''
+        scores: over the layout of objective_vector
+        force: on a dead end take the best label anyway instead of failing
+        return: 0/1 solution, None on a dead end
+        '''
+        N, P, Nc, Pc = self.N, self.P, self.Nc, self.Pc
+        score = scores[:N * P].reshape(N, P)
+        # presolve fixings and pruned labels narrow the domains
+        keep = (self.var_map >= 0) | (self.x0 > 0)
+        domain = keep[:N * P].reshape(N, P).copy()
+        rev_idx, rev_idx_c = self.rev_index()
+        if (Nc > 0) and (self.partner(0, Nc) is not None):
+            # with symmetry one direction of a causal pair causes the other:
+            # its temporal pair is BEFORE or AFTER
+            ti = np.array([self.pair2idx[self.pairs_c[ci]] for ci in range(Nc)])
+            before = np.arange(P) == self.label2idx['BEFORE']
+            domain[ti] &= before | before[rev_idx]
+        if not domain.all():
+            domain = self.propagate(domain, np.flatnonzero(~domain.all(axis=1)))
+            if domain is None:
+                if not force:
+                    return None
+                domain = keep[:N * P].reshape(N, P).copy()
+        labels = np.full(N, -1, dtype=int)
+        for n in np.argsort(-score.max(axis=1), kind='stable'):
+            if labels[n] >= 0:
+                continue
+            m = self.partner(n, N)
+            total = score[n] + (score[m, rev_idx] if m is not None else 0.0)
+            new = None
+            for l in np.argsort(-total, kind='stable'):
+                if not domain[n, l]:
+                    continue
+                trial = domain.copy()
+                trial[n] = np.arange(P) == l
+                new = self.propagate(trial, [n])
+                if new is not None:
+                    break
+            if new is None:
+                if not force:
+                    return None
+                l = int(np.argmax(np.where(domain[n], total, -np.inf))) if domain[n].any() else int(np.argmax(total))
+                new = domain
+                new[n] = np.arange(P) == l
+                if m is not None:
+                    new[m] = np.arange(P) == rev_idx[l]
+            domain = new
+            labels[n] = l
+            if m is not None:
+                labels[m] = rev_idx[l]
+            # the propagation may have narrowed other pairs down to one label
+            single = (labels < 0) & (domain.sum(axis=1) == 1)
+            labels[single] = domain[single].argmax(axis=1)
+
+        # causal after temporal: causes needs the temporal pair to be BEFORE
+        labels_c = np.zeros(Nc, dtype=int)
+        if Nc > 0:
+            score_c = scores[N * P:].reshape(Nc, Pc)
+            domain_c = keep[N * P:].reshape(Nc, Pc).copy()
+            ti = np.array([self.pair2idx[self.pairs_c[ci]] for ci in range(Nc)])
+            domain_c[labels[ti] != self.label2idx['BEFORE'], self.label2idx_c['causes']] = False
+            done = np.zeros(Nc, dtype=bool)
+            for ci in np.argsort(-score_c.max(axis=1), kind='stable'):
+                if done[ci]:
+                    continue
+                m = self.partner(ci, Nc)
+                total = score_c[ci] + (score_c[m, rev_idx_c] if m is not None else 0.0)
+                ok = domain_c[ci] & (domain_c[m, rev_idx_c] if m is not None else True)
+                if not ok.any():
+                    if not force:
+                        return None
+                    ok = np.ones(Pc, dtype=bool)
+                labels_c[ci] = int(np.argmax(np.where(ok, total, -np.inf)))
+                done[ci] = True
+                if m is not None:
+                    labels_c[m] = rev_idx_c[labels_c[ci]]
+                    done[m] = True
+
+        return self.one_hot(labels, labels_c)
+
+
+class LP_Inference(Greedy_Inference):
+    '''
+    LP relaxation of the ILP (HiGHS through scipy), rounded by the greedy
+    decoder ordered by the LP values: an integral LP solution is kept as is,
+    fractional pairs are repaired to stay consistent.
+    '''
+
+    def __init__(self, pairs, probs, pairs_c, probs_c, label2idx, label2idx_c, backward=True, trans_only=False,
+                 **kwargs):
+        super().__init__(pairs, probs, pairs_c, probs_c, label2idx, label2idx_c,
+                         backward=backward, trans_only=trans_only, **kwargs)
+        self.A, self.lb, self.ub = None, None, None
+
+    def build(self):
+        super().build()
+        self.A, self.lb, self.ub = self.constraints()
+
+    def scores(self):
+        c = self.objective()
+        res = milp(-c, integrality=np.zeros(len(c)), bounds=Bounds(0, 1),
+                   constraints=LinearConstraint(self.A, self.lb, self.ub))
+        if res.x is None:
+            self.stats['lp_failed'] += 1
+            return self.objective_vector()
+        x = self.expand(res.x)
+        self.stats['lp_fractional'] += int((np.abs(x - np.round(x)) > 1e-6).any())
+        # ties between LP values go to the local scores
+        return x + 1e-3 * self.objective_vector()
@@ -3,266 +3,106 @@ from pathlib import Path
 from collections import OrderedDict
 from typing import Iterator, List, Mapping, Union, Optional, Set
 import numpy as np
+import os
 import pickle
-from base import rev_map, rev_causal_map, ClassificationReport
+from ilp_inference import ILP_Inference
 import copy
 
-class Gurobi_Inference():
-    
-    def __init__(self, pairs, probs, pairs_c, probs_c, label2idx, label2idx_c, backward=True, trans_only=False):
-        '''
-        pairs: list of str tuple ; (docid_eventid, docid_eventid)
-        probs: a numpy matrix of local prediction scores; (#instance, #classes)
-        probs_c: a numpy matrix of local prediction scores; (#causal instance, #causal class)
-        '''
-        self.model = Model("event_event_rel")
-        
-        # temporal
-        self.pairs = pairs
-        self.idx2pair = {n: self.pairs[n] for n in range(len(pairs))}
-        self.pair2idx = {v:k for k,v in self.idx2pair.items()}
-        self.probs = probs
-        self.label2idx = label2idx
-        self.idx2label = OrderedDict([(v,k) for k,v in label2idx.items()])
-        self.rev_map = rev_map
-        self.rev_causal_map = rev_causal_map
-        self.N, self.P = probs.shape
-        self.pred_labels = list(np.argmax(probs, axis=1)) # size: self.N
-        
-        # causal
-        self.pairs_c = pairs_c
-        self.idx2pair_c = {n: self.pairs_c[n] for n in range(len(pairs_c))}
-        self.pairs2idx_c = {v:k for k,v in self.idx2pair.items()}
-        self.probs_c = probs_c
-        self.label2idx_c = label2idx_c
-        self.idx2label_c = OrderedDict([(v,k) for k,v in label2idx_c.items()])
-        self.Nc, self.Pc = probs_c.shape
-        self.pred_labels_c = []
-        if self.Nc > 0:
-            self.pred_labels_c = list(np.argmax(probs_c, axis=1))
-        self.backward=backward
-        self.trans_only=trans_only
-
-    def define_vars(self):
-        var_table = []
-        # temporal variables
-        for n in range(self.N):
-            sample = []
-            for p in range(self.P):
-                sample.append(self.model.addVar(vtype=GRB.BINARY, name="y_%s_%s"%(n,p)))
-            var_table.append(sample)
-
-        # causal variables
-        for n in range(self.Nc):
-            sample = []
-            for p in range(self.Pc):
-                sample.append(self.model.addVar(vtype=GRB.BINARY, name="yc_%s_%s"%(n,p)))
-            var_table.append(sample)
-        return var_table # [self.N * self.P] + [self.Nc * self.Pc]
-        
-    def objective(self, samples, p_table, p_table_c):
-    
-        obj = 0.0
-        assert len(samples) == self.N + self.Nc
-        assert len(samples[0]) == self.P
-        
-        # temporal
-        for n in range(self.N):
-            for p in range(self.P):
-                obj += samples[n][p] * p_table[n][p]
-
-        # causal
-        for n in range(self.N, self.N + self.Nc):
-            for p in range(self.Pc):
-                obj += samples[n][p] * p_table_c[n - self.N][p]
+_envs = {} # pid -> its Gurobi environment, shared by every model of the process
 
-        return obj
-    
-    def single_label(self, sample):
-        return sum(sample) == 1
-
-    def grammar_rules(self, sample, label):
-        return sample[self.label2idx[label]] == 1
+def get_env():
+    # the license check and the banner happen once per process, not per
+    # model; a forked worker must not use the environment of its parent
+    pid = os.getpid()
+    if pid not in _envs:
+        env = Env(empty=True)
+        env.setParam('OutputFlag', 0)
+        env.start()
+        _envs[pid] = env
+    return _envs[pid]
 
-    def transitivity_list(self):
-        transitivity_samples = []
-        pair2idx = self.pair2idx
-        for k, (e1, e2) in self.idx2pair.items():
-            for (re1, re2), i in pair2idx.items():
-                if (e2 == re1) and ((e1, re2) in pair2idx.keys()):
-                    transitivity_samples.append((pair2idx[(e1, e2)], pair2idx[(re1, re2)], pair2idx[(e1, re2)]))
-        return transitivity_samples
+class Gurobi_Inference(ILP_Inference):
     
-    def transitivity_criteria(self, tab, triplet):
-        r1, r2, r3 = triplet
-        ld = self.label2idx
-        if 'INCLUDES' in ld.keys():
-            return [
-                    tab[r1][ld['BEFORE']] + tab[r2][ld['BEFORE']] - tab[r3][ld['BEFORE']],
-                    tab[r1][ld['AFTER']] + tab[r2][ld['AFTER']] - tab[r3][ld['AFTER']],
-                    tab[r1][ld['SIMULTANEOUS']] + tab[r2][ld['SIMULTANEOUS']] - tab[r3][ld['SIMULTANEOUS']],
-                    tab[r1][ld['INCLUDES']] + tab[r2][ld['INCLUDES']] - tab[r3][ld['INCLUDES']],
-                    tab[r1][ld['IS_INCLUDED']] + tab[r2][ld['IS_INCLUDED']] - tab[r3][ld['IS_INCLUDED']],
-                    #tab[r1][ld['VAGUE']] + tab[r2][ld['VAGUE']] - tab[r3][ld['VAGUE']],
-                    tab[r1][ld['BEFORE']] + tab[r2][ld['VAGUE']] - tab[r3][ld['BEFORE']] - tab[r3][ld['VAGUE']] - tab[r3][ld['INCLUDES']] - tab[r3][ld['IS_INCLUDED']],
-                    tab[r1][ld['BEFORE']] + tab[r2][ld['INCLUDES']] - tab[r3][ld['BEFORE']] - tab[r3][ld['VAGUE']] - tab[r3][ld['INCLUDES']],
-                    tab[r1][ld['BEFORE']] + tab[r2][ld['IS_INCLUDED']] - tab[r3][ld['BEFORE']] - tab[r3][ld['VAGUE']] - tab[r3][ld['IS_INCLUDED']],
-                    tab[r1][ld['AFTER']] + tab[r2][ld['VAGUE']] - tab[r3][ld['AFTER']] - tab[r3][ld['VAGUE']] - tab[r3][ld['INCLUDES']] - tab[r3][ld['IS_INCLUDED']],
-                    tab[r1][ld['AFTER']] + tab[r2][ld['INCLUDES']] - tab[r3][ld['AFTER']] - tab[r3][ld['VAGUE']] - tab[r3][ld['INCLUDES']],
-                    tab[r1][ld['AFTER']] + tab[r2][ld['IS_INCLUDED']] - tab[r3][ld['AFTER']] - tab[r3][ld['VAGUE']] - tab[r3][ld['IS_INCLUDED']],
-                    tab[r1][ld['INCLUDES']] + tab[r2][ld['VAGUE']] - tab[r3][ld['INCLUDES']] - tab[r3][ld['AFTER']] - tab[r3][ld['VAGUE']] - tab[r3][ld['BEFORE']],
-                    tab[r1][ld['INCLUDES']] + tab[r2][ld['BEFORE']] - tab[r3][ld['INCLUDES']] - tab[r3][ld['VAGUE']] - tab[r3][ld['BEFORE']],
-                    tab[r1][ld['INCLUDES']] + tab[r2][ld['AFTER']] - tab[r3][ld['INCLUDES']] - tab[r3][ld['VAGUE']] - tab[r3][ld['AFTER']],
-                    tab[r1][ld['IS_INCLUDED']] + tab[r2][ld['VAGUE']] - tab[r3][ld['IS_INCLUDED']] - tab[r3][ld['VAGUE']] - tab[r3][ld['BEFORE']] - tab[r3][ld['AFTER']],
-                    tab[r1][ld['IS_INCLUDED']] + tab[r2][ld['BEFORE']] - tab[r3][ld['BEFORE']] - tab[r3][ld['VAGUE']] - tab[r3][ld['IS_INCLUDED']],
-                    tab[r1][ld['IS_INCLUDED']] + tab[r2][ld['AFTER']] - tab[r3][ld['AFTER']] - tab[r3][ld['VAGUE']] - tab[r3][ld['IS_INCLUDED']],
-                    tab[r1][ld['VAGUE']] + tab[r2][ld['BEFORE']] - tab[r3][ld['BEFORE']] - tab[r3][ld['VAGUE']] - tab[r3][ld['INCLUDES']] - tab[r3][ld['IS_INCLUDED']],
-                    tab[r1][ld['VAGUE']] + tab[r2][ld['AFTER']] - tab[r3][ld['AFTER']] - tab[r3][ld['VAGUE']] - tab[r3][ld['INCLUDES']] - tab[r3][ld['IS_INCLUDED']],
-                    tab[r1][ld['VAGUE']] + tab[r2][ld['INCLUDES']] - tab[r3][ld['INCLUDES']] - tab[r3][ld['VAGUE']] - tab[r3][ld['BEFORE']] - tab[r3][ld['AFTER']],
-                    tab[r1][ld['VAGUE']] + tab[r2][ld['IS_INCLUDED']] - tab[r3][ld['IS_INCLUDED']] - tab[r3][ld['VAGUE']] - tab[r3][ld['BEFORE']] - tab[r3][ld['AFTER']],
-                    tab[r1][ld['BEFORE']] + tab[r2][ld['SIMULTANEOUS']] - tab[r3][ld['BEFORE']],
-                    tab[r1][ld['AFTER']] + tab[r2][ld['SIMULTANEOUS']] - tab[r3][ld['AFTER']],
-                    tab[r1][ld['INCLUDES']] + tab[r2][ld['SIMULTANEOUS']] - tab[r3][ld['INCLUDES']],
-                    tab[r1][ld['IS_INCLUDED']] + tab[r2][ld['SIMULTANEOUS']] - tab[r3][ld['IS_INCLUDED']],
-                   ]
-        else:
-            return [
-                    tab[r1][ld['BEFORE']] + tab[r2][ld['BEFORE']] - tab[r3][ld['BEFORE']],
-                    tab[r1][ld['AFTER']] + tab[r2][ld['AFTER']] - tab[r3][ld['AFTER']],
-                    tab[r1][ld['SIMULTANEOUS']] + tab[r2][ld['SIMULTANEOUS']] - tab[r3][ld['SIMULTANEOUS']],
-                    tab[r1][ld['BEFORE']] + tab[r2][ld['VAGUE']] - tab[r3][ld['BEFORE']] - tab[r3][ld['VAGUE']],
-                    tab[r1][ld['AFTER']] + tab[r2][ld['VAGUE']] - tab[r3][ld['AFTER']] - tab[r3][ld['VAGUE']],
-                    tab[r1][ld['VAGUE']] + tab[r2][ld['BEFORE']] - tab[r3][ld['BEFORE']] - tab[r3][ld['VAGUE']],
-                    tab[r1][ld['VAGUE']] + tab[r2][ld['AFTER']] - tab[r3][ld['AFTER']] - tab[r3][ld['VAGUE']],
-                    tab[r1][ld['BEFORE']] + tab[r2][ld['SIMULTANEOUS']] - tab[r3][ld['BEFORE']],
-                    tab[r1][ld['AFTER']] + tab[r2][ld['SIMULTANEOUS']] - tab[r3][ld['AFTER']],
-                   ]
+    def __init__(self, pairs, probs, pairs_c, probs_c, label2idx, label2idx_c, backward=True, trans_only=False,
+                 **kwargs):
+        super().__init__(pairs, probs, pairs_c, probs_c, label2idx, label2idx_c,
+                         backward=backward, trans_only=trans_only, **kwargs)
+        self.model = None # created by build()
+        self.x = None
 
-    def symmetry_constraints(self, samples, n, causal=False):
-        # Note: Here is assert samples is made up by (normal instance, reverse
-        # insatnce)
-        constraints = []
-        if causal:
-            offset = int(len(self.pairs_c) / 2)
-            for label, idx in self.label2idx_c.items():
-                rev_idx = self.label2idx_c[self.rev_causal_map[label]]
-                constraints.append(samples[n][idx] == samples[n+offset][rev_idx])
+    def define_vars(self):
+        # one binary MVar over the free variables of the layout of
+        # objective_vector: [y_n_p (N * P)] + [yc_n_p (Nc * Pc)]
+        return self.model.addMVar(len(self.free), vtype=GRB.BINARY, name="y")
+
+    def add_constraints(self, A, lb, ub):
+        # rows with lb == ub are equalities, the others are A x <= ub
+        sense = np.where(lb == ub, GRB.EQUAL, GRB.LESS_EQUAL)
+        self.model.addMConstr(A, self.x, sense, ub)
+
+    def build(self):
+        self.model = Model("event_event_rel", env=get_env())
+        if self.threads is not None:
+            self.model.setParam('Threads', self.threads)
+        if self.mip_gap is not None:
+            self.model.setParam('MIPGap', self.mip_gap)
+
+        # Define variables
+        self.x = self.define_vars()
+
+        # Set objective 
+        self.set_objective()
+
+        # Define constrains, with lazy the transitivity is added as cutting planes
+        if self.lazy:
+            self.add_constraints(*self.constraints(trans_triples=np.zeros((0, 3), dtype=np.int32)))
         else:
-            offset = int(len(self.pairs) / 2)
-            for label, idx in self.label2idx.items():
-                rev_idx = self.label2idx[self.rev_map[label]]
-                constraints.append(samples[n][idx] == samples[n+offset][rev_idx])
-        return constraints
-        
-    def tense_relation(self, n):
-        label = None
-        if self.report_dominance:
-            if (self.tenses[n][0] in ['PRESENT']) and (self.tenses[n][1] in ['PAST']):
-                label = 'AFTER'
-            elif (self.tenses[n][0] in ['PRESENT']) and (self.tenses[n][1] in ['PRESENT']) and (self.aspect[n][1] in ['PERFECTIVE']):
-                label = 'AFTER'
-            elif (self.tenses[n][0] in ['PRESENT']) and (self.tenses[n][1] in ['FUTURE']):
-                label = 'BEFORE'
-            elif (self.tenses[n][0] in ['PAST']) and (self.tenses[n][1] in ['PAST']) and (self.aspect[n][1] in ['PERFECTIVE']):
-                label = 'AFTER'
-        return label
-
-
-    def causal_temporal(self, samples, ti, ci):
-        # if a relation is classified as "causes"; its temporal relation should be before
-        return samples[ci][self.label2idx_c['causes']] <= samples[ti][self.label2idx['BEFORE']]
-
-    def define_constraints(self, var_table):
-        # Constraint 1: single label assignment
-        for n in range(self.N + self.Nc):
-            self.model.addConstr(self.single_label(var_table[n]), "c1_%s" % n)
-        
-        # Constraint 2: transitivity
-        trans_triples = self.transitivity_list()
-        t = 0
-        for triple in trans_triples:
-            for ci in self.transitivity_criteria(var_table, triple):
-                self.model.addConstr(ci <= 1, "c2_%s" % t)
-                t += 1
-        
-        if (self.backward) and (not(self.trans_only)):
-            # Constraint 3: Symmetry
-            offset = int(len(self.pairs) / 2)
-            for n in range(offset):
-                for si in self.symmetry_constraints(var_table, n):
-                    self.model.addConstr(si,  "c3_%s" % n)
-            offset = int(len(self.pairs_c) / 2)
-            for n in range(offset):
-                for si in self.symmetry_constraints(var_table, n+self.N, causal=True):
-                    self.model.addConstr(si,  "c3_1_%s" % n)
-        
-        # Constraint 3: grammar rules
-        #for n in range(self.N):
-        #    label = self.tense_relation(n)
-        #    if label:
-        #        self.model.addConstr(self.grammar_rules(var_table[n], label), "c3_%s" % n)
-        
-        # Constraint 4: Temporal + Causal
-        if self.Nc > 0:
-            for ci in range(self.Nc):
-                ti = self.pair2idx[self.pairs_c[ci]] # lookup the same temporal pair as causal pair
-                self.model.addConstr(self.causal_temporal(var_table, ti, ci+self.N), "c4_%s" % ci)
-        return 
-    
-    def run(self):
+            self.add_constraints(*self.constraints())
+        if self.lazy and (self.added is not None) and self.added.any():
+            # the cuts found so far: update() builds the grown document again
+            # (an MVar cannot grow in place before gurobipy 10)
+            self.add_transitivity(self.trans_triples[self.added])
+        self.model.setParam('OutputFlag', False)
+
+    def set_objective(self):
+        self.model.setObjective(self.objective() @ self.x, GRB.MAXIMIZE)
+
+    def set_start(self, x):
+        self.x.Start = x
+        return True
+
+    def add_transitivity(self, trans_triples):
+        A, lb, ub = self.transitivity_constraints(trans_triples)
+        self.model.addMConstr(A, self.x, GRB.LESS_EQUAL, ub)
+
+    def optimize(self):
+        if self.time_limit is not None:
+            self.model.setParam('TimeLimit', self.time_left())
+        self.model.optimize()
+        self.nodes += int(self.model.NodeCount)
+        if self.model.Status == GRB.TIME_LIMIT:
+            self.timed_out = True
+        if self.model.SolCount == 0:
+            self.solution = None
+            return None
+        self.solution = self.expand(np.round(self.x.X))
+        self.obj_val = float(self.objective_vector().dot(self.solution))
+        return self.solution[:self.N * self.P].reshape(self.N, self.P).argmax(axis=1)
+
+    def run(self, start=None):
         try:
-            # Define variables
-            var_table = self.define_vars()
-
-            # Set objective 
-            self.model.setObjective(self.objective(var_table, self.probs, self.probs_c), 
-                                    GRB.MAXIMIZE)
-            
-            # Define constrains
-            self.define_constraints(var_table)
-
-            # run model
-            self.model.setParam('OutputFlag', False)
-            self.model.optimize()
-            
+            super().run(start)
         except GurobiError:
             print('Error reported')
 
-    def predict(self):
-        count = 0
-        for v in self.model.getVars():
-            # sample type (T or C)
-            is_causal = (v.varName.split('_')[0] == 'yc')
-            # sample idx
-            s_idx = int(v.varName.split('_')[1])
-            # sample class index
-            c_idx = int(v.varName.split('_')[2])
-
-            if v.x == 1.0:
-                if is_causal:
-                    if self.pred_labels_c[s_idx] != c_idx:
-                        self.pred_labels_c[s_idx] = c_idx
-                        count += 1
-                else:
-                    if self.pred_labels[s_idx] != c_idx:
-                        self.pred_labels[s_idx] = c_idx
-                        count += 1
-        print('# of global correction: %s' % count)
-        print('Objective Function Value:', self.model.objVal)
-        return 
-    
-    def evaluate(self, true_labels, exclude_vague=True):
-        assert len(true_labels) == len(self.pred_labels) + len(self.pred_labels_c)
-        labels_t =  [self.idx2label[x.item()] for x in true_labels[:self.N]]
-        pred_labels =  [self.idx2label[x] for x in self.pred_labels]
-        assert len(labels_t) == len(pred_labels)
-        
-        #print(ClassificationReport("Event-Event-Rel-Global", labels_t, pred_labels, exclude_vague))
-        if self.Nc > 0:
-            labels_c = [self.idx2label_c[x.item()] for x in true_labels[self.N:]]
-            pred_labels_c = [self.idx2label_c[x] for x in self.pred_labels_c]
+    def rerun(self, probs, probs_c, start=None):
+        try:
+            super().rerun(probs, probs_c, start)
+        except GurobiError:
+            print('Error reported')
 
-            assert len(labels_c) == len(pred_labels_c)
-            correct = [x for x in range(len(labels_c)) if pred_labels_c[x] == labels_c[x]]
-            #print("Causal Accurracy is: %.4f" % (float(len(correct)) / float(len(labels_c))))
-        return copy.deepcopy(self.pred_labels)
+    def update(self, pairs, probs, pairs_c=[], probs_c=None, start=None):
+        try:
+            super().update(pairs, probs, pairs_c, probs_c, start)
+        except GurobiError:
+            print('Error reported')
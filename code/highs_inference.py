@@ -0,0 +1,66 @@
+import numpy as np
+from scipy import sparse
+from scipy.optimize import milp, LinearConstraint, Bounds
+from ilp_inference import ILP_Inference
+
+class HiGHS_Inference(ILP_Inference):
+    '''
+    Same ILP as Gurobi_Inference, solved by scipy's HiGHS MILP solver so
+    that global inference runs without a Gurobi license. scipy does not
+    expose the HiGHS threads, threads is ignored.
+    '''
+
+    def __init__(self, pairs, probs, pairs_c, probs_c, label2idx, label2idx_c, backward=True, trans_only=False,
+                 **kwargs):
+        super().__init__(pairs, probs, pairs_c, probs_c, label2idx, label2idx_c,
+                         backward=backward, trans_only=trans_only, **kwargs)
+        self.c = None
+        self.A, self.lb, self.ub = None, None, None
+
+    def build(self):
+        # HiGHS has no persistent model: keep the sparse system instead
+        self.set_objective()
+        if self.lazy:
+            self.A, self.lb, self.ub = self.constraints(trans_triples=np.zeros((0, 3), dtype=np.int32))
+        else:
+            self.A, self.lb, self.ub = self.constraints()
+
+    def extend(self, col_map, A, lb, ub):
+        # the kept rows move to the new columns, the new rows are appended
+        old = self.A.tocoo()
+        old = sparse.csr_matrix((old.data, (old.row, col_map[old.col])), shape=(old.shape[0], len(self.free)))
+        self.A = sparse.vstack((old, A), format='csr')
+        self.lb = np.concatenate((self.lb, lb))
+        self.ub = np.concatenate((self.ub, ub))
+        self.set_objective()
+
+    def set_objective(self):
+        self.c = self.objective()
+
+    def add_transitivity(self, trans_triples):
+        A, lb, ub = self.transitivity_constraints(trans_triples)
+        self.A = sparse.vstack((self.A, A), format='csr')
+        self.lb = np.concatenate((self.lb, lb))
+        self.ub = np.concatenate((self.ub, ub))
+
+    def optimize(self):
+        options = {}
+        if self.time_limit is not None:
+            options['time_limit'] = self.time_left()
+        if self.mip_gap is not None:
+            options['mip_rel_gap'] = self.mip_gap
+        # milp minimizes
+        res = milp(-self.c, integrality=np.ones(len(self.c)), bounds=Bounds(0, 1),
+                   constraints=LinearConstraint(self.A, self.lb, self.ub), options=options)
+        if res.mip_node_count is not None:
+            self.nodes += int(res.mip_node_count)
+        if res.status == 1: # time (or node) limit, res.x is the incumbent if any
+            self.timed_out = True
+        if res.x is None:
+            if (not self.reduced()) and (not self.timed_out): # otherwise run() falls back to the full ILP
+                print('Error reported: %s' % res.message)
+            self.solution = None
+            return None
+        self.solution = self.expand(np.round(res.x))
+        self.obj_val = float(self.objective_vector().dot(self.solution))
+        return self.solution[:self.N * self.P].reshape(self.N, self.P).argmax(axis=1)
@@ -0,0 +1,1355 @@
+from collections import OrderedDict, Counter
+import abc
+import os
+import hashlib
+import json
+import numpy as np
+import multiprocessing as mp
+import queue
+import threading
+import time
+from scipy import sparse
+from base import rev_map, rev_causal_map, get_composition
+import copy
+
+_compiled = {}
+
+def compile_composition(label2idx):
+    '''
+    Compile the composition table of the label set (base.get_composition),
+    once per label set. Rule k, (a, b) -> S, is the row
+    y_ij[a] + y_jk[b] - sum_{c in S} y_ik[c] <= 1 of a triple (ij, jk, ik).
+    return: template (#rules, 3, P) of the row coefficients,
+            allowed (P, P, P) bool, whether labels a, b, c of a triple
+            break no rule
+    '''
+    key = tuple(label2idx.items())
+    if key not in _compiled:
+        table = get_composition(label2idx)
+        P = len(label2idx)
+        template = np.zeros((len(table), 3, P))
+        allowed = np.ones((P, P, P), dtype=bool)
+        for k, ((a, b), labels) in enumerate(table.items()):
+            a, b, c = label2idx[a], label2idx[b], [label2idx[l] for l in labels]
+            template[k, 0, a] = 1.0
+            template[k, 1, b] = 1.0
+            template[k, 2, c] = -1.0
+            ruled_out = np.ones(P, dtype=bool)
+            ruled_out[c] = False
+            allowed[a, b, ruled_out] = False
+        _compiled[key] = (template, allowed)
+    return _compiled[key]
+
+class ILP_Inference(abc.ABC):
+    '''
+    Solver independent part of the global inference: the pairs, the local
+    scores and the constraint system. A solver backend subclasses it and
+    implements build(), set_objective(), optimize() and add_transitivity()
+    over the variables left by presolve(): objective(), constraints(),
+    transitivity_constraints() and expand() give the reduced problem.
+    update() grows a solved document by new pairs; backends that keep a
+    model override extend() to add to it instead of building it again.
+    '''
+    
+    def __init__(self, pairs, probs, pairs_c, probs_c, label2idx, label2idx_c, backward=True, trans_only=False,
+                 lazy=False, fix=None, prune=None, threads=None, time_limit=None, mip_gap=None, dump_dir=None):
+        '''
+        pairs: list of str tuple ; (docid_eventid, docid_eventid)
+        probs: a numpy matrix of local prediction scores; (#instance, #classes)
+        probs_c: a numpy matrix of local prediction scores; (#causal instance, #causal class)
+        lazy: add the transitivity constraints as cutting planes, only for the
+              triples the current solution violates
+        fix: pairs whose top score is >= fix are fixed to their argmax
+        prune: labels scoring < prune are dropped (never the argmax)
+        fix and prune trade exactness for a smaller ILP; None turns them off
+        threads: solver threads per solve, None for the solver's default
+        time_limit: seconds per document; a solve running out of time keeps
+                    its best incumbent, or the local argmax if it has none
+        mip_gap: relative MIP gap the solve may stop at
+        dump_dir: solve_document saves every document there (see dump())
+        '''
+        # temporal
+        self.pairs = pairs
+        self.idx2pair = {n: self.pairs[n] for n in range(len(pairs))}
+        self.pair2idx = {v:k for k,v in self.idx2pair.items()}
+        self.probs = probs
+        self.label2idx = label2idx
+        self.idx2label = OrderedDict([(v,k) for k,v in label2idx.items()])
+        self.rev_map = rev_map
+        self.rev_causal_map = rev_causal_map
+        self.N, self.P = probs.shape
+        self.pred_labels = list(np.argmax(probs, axis=1)) # size: self.N
+        
+        # causal
+        self.pairs_c = pairs_c
+        self.idx2pair_c = {n: self.pairs_c[n] for n in range(len(pairs_c))}
+        self.pair2idx_c = {v:k for k,v in self.idx2pair_c.items()}
+        self.probs_c = probs_c
+        self.label2idx_c = label2idx_c
+        self.idx2label_c = OrderedDict([(v,k) for k,v in label2idx_c.items()])
+        self.Nc, self.Pc = probs_c.shape
+        self.pred_labels_c = []
+        if self.Nc > 0:
+            self.pred_labels_c = list(np.argmax(probs_c, axis=1))
+        self.backward=backward
+        self.trans_only=trans_only
+        self.lazy=lazy
+        self.fix=fix
+        self.prune=prune
+        self.threads=threads
+        self.time_limit=time_limit
+        self.mip_gap=mip_gap
+        self.dump_dir=dump_dir
+        self.deadline = None # time.time() the time_limit runs out at
+        self.timed_out = False
+        self.nodes = 0 # branch-and-bound nodes of the last solve()
+
+        self.obj_val = 0.0
+        self.solution = None # 0/1 vector over the layout of objective_vector
+        self.stats = Counter() # solver telemetry, summed over documents
+        self.trans_triples = None
+        self.events = None # (successors, predecessors) of every event, see pair_index()
+        self.added = None # triples whose transitivity is in the model (lazy)
+        self.free = None # variables left to the solver, see presolve()
+        self.var_map = None # variable -> its column among the free ones, -1 if fixed
+        self.S = None # substitution matrix, x = x0 + S x_free
+        self.x0 = None # values of the fixed variables
+        self.system = None # reduced constraint system from presolve()
+
+    @abc.abstractmethod
+    def build(self):
+        # create the variables, the objective and the constraints
+        pass
+
+    @abc.abstractmethod
+    def set_objective(self):
+        # replace the objective coefficients by objective_vector()
+        pass
+
+    @abc.abstractmethod
+    def optimize(self):
+        # solve the current model, set self.solution and self.obj_val
+        # return: temporal labels of the solution, None if there is none
+        pass
+
+    @abc.abstractmethod
+    def add_transitivity(self, trans_triples):
+        pass
+
+    def extend(self, col_map, A, lb, ub):
+        '''
+        Grow the model after update(): col_map maps the old free variables
+        to their column now, A / lb / ub are the rows of the new pairs over
+        the free variables. By default the model is built again.
+        '''
+        self.build()
+
+    def set_start(self, x):
+        # MIP start over the layout of objective_vector, returns whether the
+        # solver took it (scipy's milp has no MIP start)
+        return False
+
+    def run(self, start=None):
+        '''
+        start: (temporal labels, causal labels) to seed the solver with
+        '''
+        self.stats = Counter()
+        self.presolve()
+        self.build()
+        self.solve(start)
+        if (self.solution is None) and (self.reduced()):
+            # the fixings conflict over several rows: release every pair
+            # they bind, then as a last resort solve the full ILP
+            self.presolve(strict=True)
+            self.build()
+            self.solve(start)
+        if (self.solution is None) and (self.reduced()):
+            self.stats['presolve_undone'] += 1
+            self.presolve(reduce=False)
+            self.build()
+            self.solve(start)
+
+    def rerun(self, probs, probs_c, start=None):
+        '''
+        Solve again for new local scores of the same pairs: variables,
+        constraints and lazy cuts are kept, only the objective is updated.
+        '''
+        self.probs = probs
+        self.probs_c = probs_c
+        self.pred_labels = list(np.argmax(probs, axis=1))
+        if self.Nc > 0:
+            self.pred_labels_c = list(np.argmax(probs_c, axis=1))
+        if (self.fix is not None) or (self.prune is not None):
+            # the fixings depend on the scores: rebuild
+            self.run(start)
+            return
+        self.stats = Counter()
+        self.set_objective()
+        self.solve(start)
+
+    def one_hot(self, labels, labels_c):
+        # labels -> 0/1 vector over the layout of objective_vector
+        x = np.zeros(self.N * self.P + self.Nc * self.Pc)
+        x[np.arange(self.N) * self.P + np.asarray(labels, dtype=int)] = 1.0
+        x[self.N * self.P + np.arange(self.Nc) * self.Pc + np.asarray(labels_c, dtype=int)] = 1.0
+        return x
+
+    def time_left(self):
+        # seconds left of the document's time_limit, None without a limit
+        if self.time_limit is None:
+            return None
+        return max(self.deadline - time.time(), 0.0)
+
+    def update(self, pairs, probs, pairs_c=[], probs_c=None, start=None):
+        '''
+        Incremental inference for a growing document: add pairs, with
+        backward their forward half followed by their backward half as in
+        the constructor, and solve again. Only the triples with a new pair
+        and the constraints of the new pairs are generated and handed to
+        extend(); the previous labels (the argmax for the new pairs) are the
+        MIP start. With fix / prune the fixings change: the model is rebuilt.
+        Causal pairs need their temporal pair added before or with them.
+        start: (temporal labels, causal labels) to seed the solver with instead
+        '''
+        if (probs_c is None) or (len(pairs_c) == 0):
+            pairs_c, probs_c = [], np.zeros((0, self.Pc))
+        N0, Nc0, Pc0 = self.N, self.Nc, self.Pc
+        labels, labels_c = np.argmax(self.probs, axis=1), np.zeros(Nc0, dtype=int)
+        if Nc0 > 0:
+            labels_c = np.argmax(self.probs_c, axis=1)
+        if self.solution is not None:
+            labels = self.solution[:N0 * self.P].reshape(N0, self.P).argmax(axis=1)
+            if Nc0 > 0:
+                labels_c = self.solution[N0 * self.P:].reshape(Nc0, Pc0).argmax(axis=1)
+
+        def renumber(n_old, n_new):
+            # index of the old / the new pairs in the grown list; with backward
+            # the forward halves come first, then the backward halves
+            old, new = np.arange(n_old), np.arange(n_new)
+            if not self.backward:
+                return old, n_old + new
+            h0, h1 = int(n_old / 2), int(n_new / 2)
+            return np.where(old < h0, old, old + h1), np.where(new < h1, h0 + new, 2 * h0 + new)
+
+        perm, added = renumber(N0, len(pairs))
+        perm_c, added_c = renumber(Nc0, len(pairs_c))
+        order = np.argsort(np.concatenate((perm, added)))
+        order_c = np.argsort(np.concatenate((perm_c, added_c)))
+        new_pairs = list(self.pairs) + list(pairs)
+        new_pairs_c = list(self.pairs_c) + list(pairs_c)
+        self.pairs = [new_pairs[i] for i in order]
+        self.probs = np.concatenate((self.probs, probs))[order]
+        self.pairs_c = [new_pairs_c[i] for i in order_c]
+        self.probs_c = np.concatenate((self.probs_c, probs_c))[order_c] if Nc0 > 0 else probs_c[order_c]
+        self.idx2pair = {n: self.pairs[n] for n in range(len(self.pairs))}
+        self.pair2idx = {v:k for k,v in self.idx2pair.items()}
+        self.idx2pair_c = {n: self.pairs_c[n] for n in range(len(self.pairs_c))}
+        self.pair2idx_c = {v:k for k,v in self.idx2pair_c.items()}
+        self.N, self.P = self.probs.shape
+        self.Nc, self.Pc = self.probs_c.shape
+        self.pred_labels = list(np.argmax(self.probs, axis=1))
+        self.pred_labels_c = list(np.argmax(self.probs_c, axis=1)) if self.Nc > 0 else []
+        if start is None:
+            start = (np.concatenate((labels, np.argmax(probs, axis=1)))[order],
+                     np.concatenate((labels_c, np.argmax(probs_c, axis=1) if len(pairs_c) > 0
+                                     else np.zeros(0, dtype=int)))[order_c])
+
+        if self.events is not None:
+            for e1, e2 in pairs:
+                self.events[0].setdefault(e1, []).append(e2)
+                self.events[1].setdefault(e2, []).append(e1)
+        new_triples = self.new_triples(added)
+        if self.trans_triples is not None:
+            self.trans_triples = np.concatenate((perm[self.trans_triples].astype(np.int32), new_triples))
+        if (self.x0 is None) or (self.fix is not None) or (self.prune is not None):
+            # nothing built yet, or the fixings depend on all the scores
+            self.run(start)
+        else:
+            # where the old free variables are in the grown layout
+            old = self.free
+            temporal = old < N0 * self.P
+            moved = np.zeros(len(old), dtype=int)
+            moved[temporal] = perm[old[temporal] // self.P] * self.P + old[temporal] % self.P
+            if Nc0 > 0:
+                o = old[~temporal] - N0 * self.P
+                moved[~temporal] = self.N * self.P + perm_c[o // Pc0] * self.Pc + o % Pc0
+            added_mask = self.added
+            self.presolve()
+            if added_mask is not None:
+                self.added = np.concatenate((added_mask, np.zeros(len(new_triples), dtype=bool)))
+            trans = np.zeros((0, 3), dtype=np.int32) if self.lazy else new_triples
+            self.extend(self.var_map[moved], *self.reduce(*self.constraint_matrix(trans, added, added_c)))
+            self.solve(start)
+        self.stats['update_pairs'] += len(pairs) + len(pairs_c)
+        self.stats['update_triples'] += len(new_triples)
+
+    def solve(self, start=None):
+        started = False
+        if start is not None:
+            x = self.one_hot(*start)
+            started = self.set_start(x[self.free])
+        start_time = time.time()
+        if self.time_limit is not None:
+            self.deadline = start_time + self.time_limit
+        self.timed_out = False
+        self.nodes = 0
+        if len(self.free) == 0:
+            # presolve fixed every variable
+            self.solution = self.x0.copy()
+            self.obj_val = float(self.objective_vector().dot(self.solution))
+        elif self.lazy:
+            self.cutting_planes()
+        else:
+            self.optimize()
+        if self.timed_out:
+            self.stats['timeouts'] += 1
+            if (self.solution is not None) and self.lazy:
+                # the incumbent of the relaxed model may break triples that
+                # were never added as cuts
+                labels = self.solution[:self.N * self.P].reshape(self.N, self.P).argmax(axis=1)
+                if self.violated_triples(labels, self.trans_triples).any():
+                    self.solution = None
+                    self.stats['timeout_inconsistent'] += 1
+            if self.solution is None:
+                # no incumbent in time: the local argmax
+                self.solution = self.one_hot(np.argmax(self.probs, axis=1),
+                                             np.argmax(self.probs_c, axis=1) if self.Nc > 0 else [])
+                self.obj_val = float(self.objective_vector().dot(self.solution))
+                self.stats['timeout_argmax'] += 1
+        elapsed = time.time() - start_time
+        self.stats['solve_time'] += elapsed
+        if self.solution is not None:
+            # telemetry: solve time and nodes with / without a start, and
+            # how often the start already was the optimum
+            key = 'started' if started else 'unstarted'
+            self.stats[key] += 1
+            self.stats[key + '_time'] += elapsed
+            self.stats[key + '_nodes'] += self.nodes
+            if started:
+                self.stats['start_kept'] += int(np.array_equal(x, self.solution))
+
+    def is_consistent(self, labels, labels_c):
+        '''
+        Whether labels / labels_c satisfy every constraint of the ILP. If the
+        local argmax does, it is the optimum and no solver is needed.
+        '''
+        labels = np.asarray(labels, dtype=int)
+        labels_c = np.asarray(labels_c, dtype=int)
+        if self.trans_triples is None:
+            self.trans_triples = self.transitivity_list()
+        if self.violated_triples(labels, self.trans_triples).any():
+            return False
+        if self.symmetric():
+            rev_idx, rev_idx_c = self.rev_index()
+            half, half_c = int(self.N / 2), int(self.Nc / 2)
+            if (labels[half:] != rev_idx[labels[:half]]).any():
+                return False
+            if (labels_c[half_c:] != rev_idx_c[labels_c[:half_c]]).any():
+                return False
+        if self.Nc > 0:
+            ti = np.array([self.pair2idx[self.pairs_c[ci]] for ci in range(self.Nc)])
+            causes = labels_c == self.label2idx_c['causes']
+            if (labels[ti[causes]] != self.label2idx['BEFORE']).any():
+                return False
+        return True
+
+    def predict(self, verbose=True):
+        count = 0
+        if self.solution is not None:
+            count = self.read_solution(self.solution)
+        if verbose:
+            print('# of global correction: %s' % count)
+            print('Objective Function Value:', self.obj_val)
+        return count
+
+    def transitivity_list(self):
+        # all triples (e1,e2),(e2,e3),(e1,e3); index the pairs by their first
+        # event so that (e2,e3) are the neighbours of e2 instead of a scan over
+        # every pair. cost: sum of squared out-degrees
+        # return: int32 array (#triples, 3) of pair indices
+        pair2idx = self.pair2idx
+        successors = self.pair_index()[0]
+        transitivity_samples = []
+        for (e1, e2), i in pair2idx.items():
+            for e3 in successors.get(e2, []):
+                k = pair2idx.get((e1, e3))
+                if k is not None:
+                    transitivity_samples.append((i, pair2idx[(e2, e3)], k))
+        return np.array(transitivity_samples, dtype=np.int32).reshape(-1, 3)
+
+    def pair_index(self):
+        # successors / predecessors of every event: e1 -> [e2 of the pairs (e1, e2)]
+        if self.events is None:
+            self.events = ({}, {})
+            for e1, e2 in self.pair2idx:
+                self.events[0].setdefault(e1, []).append(e2)
+                self.events[1].setdefault(e2, []).append(e1)
+        return self.events
+
+    def new_triples(self, new):
+        '''
+        The triples with one of the pairs in new at any of the 3 places,
+        found from the neighbours of their events. cost: the degrees of the
+        new pairs, not the size of the document
+        return: int32 array (#triples, 3) of pair indices
+        '''
+        pair2idx = self.pair2idx
+        successors, predecessors = self.pair_index()
+        triples = set()
+        for n in new:
+            a, b = self.pairs[n]
+            for c in successors.get(b, []): # (a,b),(b,c),(a,c)
+                k = pair2idx.get((a, c))
+                if k is not None:
+                    triples.add((n, pair2idx[(b, c)], k))
+            for c in predecessors.get(a, []): # (c,a),(a,b),(c,b)
+                k = pair2idx.get((c, b))
+                if k is not None:
+                    triples.add((pair2idx[(c, a)], n, k))
+            for c in successors.get(a, []): # (a,c),(c,b),(a,b)
+                j = pair2idx.get((c, b))
+                if j is not None:
+                    triples.add((pair2idx[(a, c)], j, n))
+        return np.array(sorted(triples), dtype=np.int32).reshape(-1, 3)
+    
+    def compiled_criteria(self):
+        # transitivity rows of a triple: (#rules, 3, P), see compile_composition
+        return compile_composition(self.label2idx)[0]
+
+    def allowed(self):
+        # allowed[a, b, c]: labels a, b, c of a triple break no transitivity rule
+        return compile_composition(self.label2idx)[1]
+
+    def objective_vector(self):
+        # variables are laid out as [y_n_p (N * P)] + [yc_n_p (Nc * Pc)]
+        return np.concatenate((self.probs.ravel(), self.probs_c.ravel()))
+
+    def transitivity_matrix(self, trans_triples):
+        '''
+        Transitivity criteria of the given triples as sparse rows A x <= 1
+        over the variable layout of objective_vector.
+        trans_triples: int array (#triples, 3)
+        '''
+        template = self.compiled_criteria()
+        K = template.shape[0]
+        k_idx, j_idx, p_idx = np.nonzero(template)
+        T = len(trans_triples)
+        rows = (np.arange(T)[:, None] * K + k_idx).ravel()
+        cols = (trans_triples[:, j_idx].astype(int) * self.P + p_idx).ravel()
+        vals = np.tile(template[k_idx, j_idx, p_idx], T)
+        return sparse.csr_matrix((vals, (rows, cols)),
+                                 shape=(T * K, self.N * self.P + self.Nc * self.Pc))
+
+    def violated_triples(self, labels, trans_triples):
+        # labels: temporal label index per pair
+        # return: boolean mask of the triples whose labels break a rule
+        labels = labels[trans_triples]
+        return ~self.allowed()[labels[:, 0], labels[:, 1], labels[:, 2]]
+
+    def rev_index(self):
+        # label index of the reversed pair, temporal and causal
+        return (np.array([self.label2idx[self.rev_map[label]] for label in self.idx2label.values()], dtype=int),
+                np.array([self.label2idx_c[self.rev_causal_map[label]] for label in self.idx2label_c.values()],
+                         dtype=int))
+
+    def presolve(self, reduce=True, strict=False):
+        '''
+        Reduce the ILP before build():
+        - with symmetry, y_(n+N/2)_rev(p) is substituted by y_n_p: both
+          directions of a pair share one set of variables, the reversed
+          scores are folded into the objective and the symmetry constraints
+          vanish. Exact, so it is also kept by presolve(reduce=False).
+        - fix the pairs scoring >= self.fix to their argmax and the labels
+          scoring < self.prune to 0, then drop the constraints the fixings
+          leave constant or redundant (e.g. transitivity over fixed pairs).
+          With symmetry, on the mean score of both directions of a pair.
+          Pairs whose fixings violate a constraint are released (solved by
+          the ILP) and the remaining fixings kept. strict=True releases
+          every pair whose fixings still bind a constraint, which is always
+          feasible, for when the fixings conflict over several rows.
+        '''
+        N, P, Nc, Pc = self.N, self.P, self.Nc, self.Pc
+        size = N * P + Nc * Pc
+        self.x0 = np.zeros(size)
+        self.free = np.arange(size)
+        self.var_map = np.arange(size)
+        self.S = None
+        self.system = None
+        self.added = None
+        fixings = reduce and ((self.fix is not None) or (self.prune is not None))
+        if not (fixings or self.symmetric()):
+            return
+        keep = np.ones(size, dtype=bool)
+        if fixings:
+            rev_idx, rev_idx_c = self.rev_index()
+            for probs, offset, rev in ((self.probs, 0, rev_idx), (self.probs_c, N * P, rev_idx_c)):
+                if probs.shape[0] == 0:
+                    continue
+                scores, best = probs, np.argmax(probs, axis=1)
+                if self.symmetric():
+                    # both directions of a pair are decided together, on the
+                    # mean of their scores, so that their fixings agree
+                    half = int(probs.shape[0] / 2)
+                    scores = (probs[:half] + probs[half:][:, rev]) / 2.0
+                    best = np.argmax(scores, axis=1)
+                    scores = np.concatenate((scores, scores[:, rev]))
+                    best = np.concatenate((best, rev[best]))
+                n = np.arange(probs.shape[0])
+                if self.fix is not None:
+                    fixed = n[scores.max(axis=1) >= self.fix]
+                    keep[offset + (fixed[:, None] * probs.shape[1] + np.arange(probs.shape[1])).ravel()] = False
+                    self.x0[offset + fixed * probs.shape[1] + best[fixed]] = 1.0
+                if self.prune is not None:
+                    pruned = scores < self.prune
+                    pruned[n, best] = False
+                    keep[offset + np.flatnonzero(pruned)] = False
+        target = np.arange(size) # the variable each one is substituted by
+        if self.symmetric():
+            u, v = self.symmetric_vars()
+            # a fixed direction fixes the other one to the same value
+            for a, b in ((u, v), (v, u)):
+                one = keep[a] & (~keep[b])
+                keep[a[one]] = False
+                self.x0[a[one]] = self.x0[b[one]]
+            target[v] = u
+            self.stats['vars_folded'] = len(v)
+            self.stats['vars_unfolded'] = size
+        self.substitute(keep, target)
+        if not fixings:
+            # the substitution alone leaves nothing to check, constraints()
+            # reduces the rows when the backend asks for them
+            return
+
+        A, lb, ub = self.constraint_matrix()
+        while True:
+            A_free, lb_free, ub_free, lo, hi = self.row_activity(A, lb, ub)
+            bad = (lo > ub_free) | (hi < lb_free)
+            if strict:
+                bad |= ~((lo >= lb_free) & (hi <= ub_free))
+            touched = np.unique(A[np.flatnonzero(bad)].indices)
+            touched = touched[~keep[touched]]
+            if not bad.any() or (strict and len(touched) == 0):
+                break
+            # the fixings violate these rows: release the pairs fixed or
+            # pruned in them (both directions) and keep the other fixings
+            if len(touched) == 0:
+                self.stats['presolve_undone'] += 1
+                self.presolve(reduce=False)
+                return
+            for lo_var, width, n_pairs, var in ((0, P, N, touched[touched < N * P]),
+                                                (N * P, Pc, Nc, touched[touched >= N * P])):
+                n = np.unique((var - lo_var) // width)
+                if self.symmetric():
+                    half = int(n_pairs / 2)
+                    n = np.unique(np.concatenate((n, (n + half) % n_pairs)))
+                var = lo_var + (n[:, None] * width + np.arange(width)).ravel()
+                keep[var] = True
+                self.x0[var] = 0.0
+                self.stats['pairs_released'] += len(n)
+            self.substitute(keep, target)
+        redundant = (lo >= lb_free) & (hi <= ub_free)
+        distinct = self.distinct_rows(A_free, lb_free, ub_free)
+        rows = (~redundant) & distinct
+        self.system = (A_free[rows], lb_free[rows], ub_free[rows])
+        self.stats['vars'] = size
+        self.stats['vars_eliminated'] = int((~keep).sum())
+        self.stats['rows'] = A.shape[0]
+        self.stats['rows_eliminated'] = int((~rows).sum())
+        self.stats['rows_folded'] = int(((~redundant) & (~distinct)).sum())
+
+    def substitute(self, keep, target):
+        # x = x0 + S x_free over the kept variables, each one standing for
+        # its target
+        size = len(keep)
+        self.free = np.flatnonzero(keep & (target == np.arange(size)))
+        self.var_map = np.full(size, -1)
+        self.var_map[self.free] = np.arange(len(self.free))
+        self.var_map[keep] = self.var_map[target[keep]]
+        kept = np.flatnonzero(keep)
+        self.S = sparse.csr_matrix((np.ones(len(kept)), (kept, self.var_map[kept])), shape=(size, len(self.free)))
+
+    def reduced(self):
+        # whether presolve fixed variables (the substitution is exact)
+        return (self.var_map < 0).any()
+
+    def symmetric(self):
+        # whether the symmetry constraints are part of the ILP
+        return (self.backward) and (not(self.trans_only))
+
+    def symmetric_vars(self, idx=None, idx_c=None):
+        # y_u == y_v: u = (n, p) of the forward half, v = (n+N/2, rev(p)),
+        # temporal then causal; only the pairs with n or n+N/2 in idx / idx_c
+        # if given. return: u, v variable indices
+        rev_idx, rev_idx_c = self.rev_index()
+        us, vs = [], []
+        for half, P, start, rev, sel in ((int(self.N / 2), self.P, 0, rev_idx, idx),
+                                         (int(self.Nc / 2), self.Pc, self.N * self.P, rev_idx_c, idx_c)):
+            pairs = np.arange(half)
+            if (sel is not None) and (half > 0):
+                pairs = np.unique(np.asarray(sel, dtype=int) % half)
+            n = np.repeat(pairs, P)
+            p = np.tile(np.arange(P), len(pairs))
+            us.append(start + n * P + p)
+            vs.append(start + (n + half) * P + rev[p])
+        return np.concatenate(us), np.concatenate(vs)
+
+    def row_activity(self, A, lb, ub):
+        # A over the free variables (substituted), bounds shifted by the
+        # fixed ones, and the min / max of every row over binary variables
+        shift = A.dot(self.x0)
+        A_free = A.dot(self.S).tocsr()
+        A_free.eliminate_zeros()
+        lo = np.asarray(A_free.minimum(0).sum(axis=1)).ravel()
+        hi = np.asarray(A_free.maximum(0).sum(axis=1)).ravel()
+        return A_free, lb - shift, ub - shift, lo, hi
+
+    def reduce(self, A, lb, ub):
+        # the rows of lb <= A x <= ub that still constrain the free variables
+        if self.S is None:
+            return A, lb, ub
+        A_free, lb, ub, lo, hi = self.row_activity(A, lb, ub)
+        keep = ~((lo >= lb) & (hi <= ub))
+        distinct = self.distinct_rows(A_free, lb, ub)
+        self.stats['rows_folded'] += int((keep & (~distinct)).sum())
+        keep &= distinct
+        return A_free[keep], lb[keep], ub[keep]
+
+    def distinct_rows(self, A, lb, ub):
+        # the first of every group of identical rows, e.g. the sum-to-one
+        # rows of both directions of a folded pair; rows are compared exactly,
+        # on the bytes of their canonical (sorted, summed) coefficients and
+        # their bounds
+        distinct = np.zeros(A.shape[0], dtype=bool)
+        A = sparse.csr_matrix(A)
+        A.sum_duplicates()
+        A.eliminate_zeros()
+        indices, data = A.indices.astype(np.int64), A.data.astype(np.float64)
+        bounds = np.column_stack((lb, ub)).astype(np.float64)
+        seen = set()
+        for i in range(A.shape[0]):
+            s, e = A.indptr[i], A.indptr[i + 1]
+            key = (indices[s:e].tobytes(), data[s:e].tobytes(), bounds[i].tobytes())
+            if key not in seen:
+                seen.add(key)
+                distinct[i] = True
+        return distinct
+
+    def objective(self):
+        # folded variables add up the scores of both directions
+        if self.S is None:
+            return self.objective_vector()
+        return self.S.T.dot(self.objective_vector())
+
+    def constraints(self, trans_triples=None):
+        # constraint_matrix over the free variables
+        if (trans_triples is None) and (self.system is not None):
+            return self.system
+        return self.reduce(*self.constraint_matrix(trans_triples))
+
+    def transitivity_constraints(self, trans_triples):
+        A = self.transitivity_matrix(trans_triples)
+        return self.reduce(A, np.full(A.shape[0], -np.inf), np.ones(A.shape[0]))
+
+    def expand(self, x):
+        # solution over the free variables -> the full variable layout
+        if self.S is None:
+            return np.asarray(x, dtype=float)
+        return self.x0 + self.S.dot(x)
+
+    def constraint_matrix(self, trans_triples=None, idx=None, idx_c=None):
+        '''
+        All constraints as one sparse system lb <= A x <= ub over the
+        variable layout of objective_vector.
+        trans_triples: the triples to add transitivity for; all by default
+        idx, idx_c: the temporal / causal pairs to add the other constraints
+                    for; all by default
+        return: A (scipy csr matrix), lb, ub
+        '''
+        N, P, Nc, Pc = self.N, self.P, self.Nc, self.Pc
+        idx = np.arange(N) if idx is None else np.asarray(idx, dtype=int)
+        idx_c = np.arange(Nc) if idx_c is None else np.asarray(idx_c, dtype=int)
+        rows, cols, vals, lb, ub = [], [], [], [], []
+
+        def add(r, c, v, lo, hi):
+            # r: row ids relative to the block; lo/hi: per row bounds
+            rows.append(r + len(lb))
+            cols.append(c)
+            vals.append(v)
+            lb.extend(lo)
+            ub.extend(hi)
+
+        # Constraint 1: single label assignment
+        for n, P_, start in ((idx, P, 0), (idx_c, Pc, N * P)):
+            add(np.repeat(np.arange(len(n)), P_), start + (n[:, None] * P_ + np.arange(P_)).ravel(),
+                np.ones(len(n) * P_), [1.0] * len(n), [1.0] * len(n))
+
+        # Constraint 2: transitivity
+        if trans_triples is None:
+            if self.trans_triples is None:
+                self.trans_triples = self.transitivity_list()
+            trans_triples = self.trans_triples
+        trans = self.transitivity_matrix(trans_triples).tocoo()
+        add(trans.row, trans.col, trans.data, [-np.inf] * trans.shape[0], [1.0] * trans.shape[0])
+
+        if self.symmetric():
+            # Constraint 3: Symmetry, y_n_p == y_(n+N/2)_rev(p)
+            u, v = self.symmetric_vars(idx, idx_c)
+            r = np.arange(len(u))
+            add(np.concatenate((r, r)), np.concatenate((u, v)),
+                np.concatenate((np.ones(len(u)), -np.ones(len(u)))),
+                [0.0] * len(u), [0.0] * len(u))
+
+        # Constraint 4: Temporal + Causal
+        if len(idx_c) > 0:
+            ti = np.array([self.pair2idx[self.pairs_c[ci]] for ci in idx_c])
+            r = np.arange(len(idx_c))
+            add(np.concatenate((r, r)),
+                np.concatenate((N * P + idx_c * Pc + self.label2idx_c['causes'],
+                                ti * P + self.label2idx['BEFORE'])),
+                np.concatenate((np.ones(len(idx_c)), -np.ones(len(idx_c)))),
+                [-np.inf] * len(idx_c), [0.0] * len(idx_c))
+
+        A = sparse.csr_matrix((np.concatenate(vals), (np.concatenate(rows), np.concatenate(cols))),
+                              shape=(len(lb), N * P + Nc * Pc))
+        return A, np.array(lb), np.array(ub)
+
+    def cutting_planes(self):
+        '''
+        Lazy transitivity: build() leaves it out; add the triples whose
+        criteria the solution violates and re-solve until the solution is
+        transitive. Cuts stay in the model for later reruns.
+        '''
+        if self.trans_triples is None:
+            self.trans_triples = self.transitivity_list()
+        if self.added is None:
+            self.added = np.zeros(len(self.trans_triples), dtype=bool)
+        labels = self.optimize()
+        while (labels is not None) and (not self.timed_out):
+            violated = self.violated_triples(labels, self.trans_triples) & (~self.added)
+            if not violated.any():
+                break
+            self.added |= violated
+            self.add_transitivity(self.trans_triples[violated])
+            self.stats['lazy_rounds'] += 1
+            labels = self.optimize()
+        self.stats['triples'] += len(self.trans_triples)
+        self.stats['lazy_triples'] += int(self.added.sum())
+
+    def config(self):
+        # constraint and solver configuration, as saved by dump()
+        return {'backward': self.backward, 'trans_only': self.trans_only, 'lazy': self.lazy,
+                'fix': self.fix, 'prune': self.prune, 'threads': self.threads,
+                'time_limit': self.time_limit, 'mip_gap': self.mip_gap}
+
+    def dump(self, path):
+        '''
+        Save the problem to path.npz: pairs, scores, label sets and config(),
+        to be solved again offline by load_problem() / replay_ilp.py, and
+        the ILP itself to path.mps for any other solver
+        '''
+        np.savez_compressed(path + '.npz', pairs=np.array(self.pairs, dtype=str).reshape(-1, 2),
+                            probs=self.probs, pairs_c=np.array(self.pairs_c, dtype=str).reshape(-1, 2),
+                            probs_c=self.probs_c, labels=json.dumps(list(self.label2idx.items())),
+                            labels_c=json.dumps(list(self.label2idx_c.items())),
+                            config=json.dumps(self.config()))
+        self.write_mps(path + '.mps')
+
+    def write_mps(self, path):
+        '''
+        The ILP after presolve, transitivity included even with lazy, in free
+        MPS: binary columns x<free variable>, rows r<i>, maximised; the score
+        of the fixed variables is the objective constant (-RHS of OBJ)
+        '''
+        full = copy.copy(self)
+        full.lazy = False
+        full.stats = Counter()
+        full.presolve()
+        c = full.objective()
+        A, lb, ub = full.constraints()
+        A = sparse.csc_matrix(A)
+        lines = ['NAME event_event_rel', 'OBJSENSE', '    MAX', 'ROWS', ' N OBJ']
+        rhs, ranges = [], []
+        for i in range(A.shape[0]):
+            if lb[i] == ub[i]:
+                lines.append(' E r%d' % i)
+                rhs.append((i, ub[i]))
+            elif np.isinf(lb[i]):
+                lines.append(' L r%d' % i)
+                rhs.append((i, ub[i]))
+            elif np.isinf(ub[i]):
+                lines.append(' G r%d' % i)
+                rhs.append((i, lb[i]))
+            else:
+                lines.append(' L r%d' % i)
+                rhs.append((i, ub[i]))
+                ranges.append((i, ub[i] - lb[i]))
+        lines.append('COLUMNS')
+        for j in range(A.shape[1]):
+            lines.append('    x%d OBJ %r' % (j, float(c[j])))
+            for k in range(A.indptr[j], A.indptr[j + 1]):
+                lines.append('    x%d r%d %r' % (j, A.indices[k], float(A.data[k])))
+        lines.append('RHS')
+        constant = float(full.objective_vector().dot(full.x0))
+        if constant != 0:
+            lines.append('    RHS OBJ %r' % -constant)
+        lines += ['    RHS r%d %r' % (i, float(v)) for i, v in rhs if v != 0]
+        if ranges:
+            lines.append('RANGES')
+            lines += ['    RNG r%d %r' % (i, float(v)) for i, v in ranges]
+        lines.append('BOUNDS')
+        lines += [' BV BND x%d' % j for j in range(A.shape[1])]
+        lines.append('ENDATA')
+        with open(path, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+
+    def read_solution(self, x):
+        # x: solution over the variable layout of objective_vector
+        # update pred_labels / pred_labels_c, return the # of changed labels
+        count = 0
+        labels = np.argmax(x[:self.N * self.P].reshape(self.N, self.P), axis=1)
+        count += int(np.sum(labels != np.array(self.pred_labels, dtype=int)))
+        self.pred_labels = list(labels)
+        if self.Nc > 0:
+            labels_c = np.argmax(x[self.N * self.P:].reshape(self.Nc, self.Pc), axis=1)
+            count += int(np.sum(labels_c != np.array(self.pred_labels_c, dtype=int)))
+            self.pred_labels_c = list(labels_c)
+        return count
+
+
+def split_documents(pairs, pairs_c, backward=True):
+    '''
+    Group pair indices by document. Pair keys are docid_eventid, so no
+    transitivity triple can span two documents and every document is an
+    independent ILP.
+    If backward, the n-th and (n+N/2)-th pairs are the two directions of the
+    same pair; each group keeps them as (forward half, backward half) so the
+    symmetry constraints still line up.
+    return: OrderedDict doc_id -> (temporal indices, causal indices)
+    '''
+    def group(keys):
+        half = int(len(keys) / 2) if backward else len(keys)
+        docs = OrderedDict()
+        for n in range(half):
+            docs.setdefault(keys[n][0].rsplit('_', 1)[0], []).append(n)
+        if backward:
+            for doc, idx in docs.items():
+                idx += [n + half for n in idx]
+        return docs
+
+    docs = group(pairs)
+    docs_c = group(pairs_c)
+    return OrderedDict([(doc, (np.array(idx, dtype=int), np.array(docs_c.get(doc, []), dtype=int)))
+                        for doc, idx in docs.items()])
+
+def load_problem(path):
+    '''
+    Read a problem saved by ILP_Inference.dump()
+    return: (pairs, probs, pairs_c, probs_c, label2idx, label2idx_c), config
+    '''
+    with np.load(path, allow_pickle=False) as f:
+        pairs = [tuple(p) for p in f['pairs'].tolist()]
+        pairs_c = [tuple(p) for p in f['pairs_c'].tolist()]
+        problem = (pairs, f['probs'], pairs_c, f['probs_c'],
+                   OrderedDict(json.loads(str(f['labels']))), OrderedDict(json.loads(str(f['labels_c']))))
+        return problem, json.loads(str(f['config']))
+
+def get_solver(solver):
+    # import the backends lazily: gurobipy is only needed for 'gurobi'
+    if solver == 'gurobi':
+        from gurobi_inference import Gurobi_Inference
+        return Gurobi_Inference
+    elif solver == 'highs':
+        from highs_inference import HiGHS_Inference
+        return HiGHS_Inference
+    elif solver == 'greedy':
+        from greedy_inference import Greedy_Inference
+        return Greedy_Inference
+    elif solver == 'lp':
+        from greedy_inference import LP_Inference
+        return LP_Inference
+    else:
+        raise ValueError('the choice of ILP solver did not exist')
+
+def solve_document(task, models=None):
+    '''
+    Solve one document. top-level so that it can run in a worker process.
+    models: cache doc_id -> solved ILP_Inference; a cached model over the same
+            pairs is re-solved with the new scores instead of being rebuilt
+    check: skip the solver if the local argmax is already consistent
+    '''
+    (doc, solver, pairs, probs, pairs_c, probs_c, label2idx, label2idx_c, backward, trans_only,
+     solver_args, start, check) = task
+    global_model = None
+    if models is not None:
+        global_model = models.get(doc)
+    reuse = (global_model is not None) and (global_model.pairs == pairs) and (global_model.pairs_c == pairs_c)
+    if not reuse:
+        # no solver model is created before build()
+        global_model = get_solver(solver)(pairs, probs, pairs_c, probs_c, label2idx, label2idx_c,
+                                          backward=backward, trans_only=trans_only, **solver_args)
+    if global_model.dump_dir is not None:
+        os.makedirs(global_model.dump_dir, exist_ok=True)
+        # a reused model still holds the scores of its last solve
+        global_model.probs, global_model.probs_c = probs, probs_c
+        global_model.dump(os.path.join(global_model.dump_dir, doc.replace(os.sep, '_')))
+    if check:
+        labels = np.argmax(probs, axis=1)
+        labels_c = np.argmax(probs_c, axis=1) if len(pairs_c) > 0 else np.zeros(0, dtype=int)
+        if global_model.is_consistent(labels, labels_c):
+            obj_val = float(probs.max(axis=1).sum() + (probs_c.max(axis=1).sum() if len(pairs_c) > 0 else 0.0))
+            return list(labels), list(labels_c), 0, obj_val, Counter(consistent=1)
+    if reuse:
+        global_model.rerun(probs, probs_c, start)
+        global_model.stats['reused'] += 1
+    else:
+        global_model.run(start)
+        if models is not None:
+            models[doc] = global_model
+    count = global_model.predict(verbose=False)
+    return (global_model.pred_labels, global_model.pred_labels_c, count, global_model.obj_val,
+            global_model.stats)
+
+def solver_worker(conn, cache):
+    # serve lists of document tasks until None is received
+    models = {} if cache else None
+    while True:
+        tasks = conn.recv()
+        if tasks is None:
+            break
+        try:
+            conn.send([solve_document(task, models) for task in tasks])
+        except Exception as e:
+            conn.send(e)
+    conn.close()
+
+def receive(conn, ready):
+    # put everything a worker sends on ready until it closes its end
+    while True:
+        try:
+            ready.put(conn.recv())
+        except (EOFError, OSError):
+            break
+
+class SolutionCache():
+    '''
+    LRU cache of document solutions, content addressed: the key is the
+    document id, a hash of its pairs and of its scores quantised to quantum,
+    and the configuration (backward, trans_only, label sets, solver and its
+    arguments). A document gets its cached labels without a solve when its
+    scores round to the same multiples of quantum as when it was solved;
+    nearby scores hit only then, a small move across a rounding boundary
+    misses.
+    capacity: #documents kept
+    '''
+
+    def __init__(self, capacity=10000, quantum=1e-3):
+        self.capacity = capacity
+        self.quantum = quantum
+        self.entries = OrderedDict() # key -> solve_document result, oldest first
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, task):
+        (doc, solver, pairs, probs, pairs_c, probs_c, label2idx, label2idx_c, backward, trans_only,
+         solver_args, start, check) = task
+        h = hashlib.sha1()
+        for table in (probs, probs_c):
+            h.update(str(table.shape).encode())
+            h.update(np.round(table / self.quantum).astype(np.int64).tobytes())
+        h.update(repr((pairs, pairs_c)).encode())
+        # threads do not change the solution
+        config = (solver, backward, trans_only, tuple(label2idx.items()), tuple(label2idx_c.items()),
+                  tuple(sorted((k, v) for k, v in solver_args.items() if k != 'threads')))
+        return doc, h.hexdigest(), repr(config)
+
+    def get(self, key):
+        # return: the cached result as a cache hit, None on a miss
+        if key not in self.entries:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.entries.move_to_end(key)
+        labels, labels_c, count, obj_val, stats = self.entries[key]
+        return labels, labels_c, count, obj_val, Counter(cache_hits=1)
+
+    def put(self, key, result):
+        self.entries[key] = result
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.capacity:
+            self.entries.popitem(last=False)
+
+    def hit_rate(self):
+        return self.hits / max(self.hits + self.misses, 1)
+
+_solution_caches = {}
+
+def get_solution_cache(capacity, quantum=1e-3):
+    # one SolutionCache per setting for the whole process, so that later
+    # runs (epochs, experiments of train_all.py) hit it too; None if capacity is 0
+    if not capacity:
+        return None
+    if (capacity, quantum) not in _solution_caches:
+        _solution_caches[(capacity, quantum)] = SolutionCache(capacity, quantum)
+    return _solution_caches[(capacity, quantum)]
+
+class DocumentInference():
+    '''
+    Global inference one document at a time (see split_documents), with the
+    per-document assignments stitched back into the original pair order.
+    workers > 1 spreads the documents over long-lived worker processes. A
+    document always goes back to the worker that solved it first, so with
+    cache=True its model (variables, constraints, lazy cuts) stays alive and
+    only the objective is updated on the next call, e.g. the next epoch.
+    solver: 'gurobi' or 'highs' (scipy's MILP solver, no license needed)
+    decoder: 'exact' - the ILP solved by solver,
+             'lp' - LP relaxation rounded with a consistency repair,
+             'greedy' - confidence-ordered decoding with propagation;
+             both fall back to solver when they run into a dead end
+    check: documents whose local argmax already satisfies every constraint
+           skip the solver, the argmax is their optimum
+    warm_start: MIP start of every solve (used by gurobi only)
+                'none', 'argmax' - the local argmax,
+                'previous' - the last solution of the same document (kept
+                across calls), the local argmax when there is none
+    solution_cache: a SolutionCache; documents found in it skip the solver
+    solver_args: passed on to the solver, e.g. lazy=True, time_limit=10;
+                 with workers > 1, threads defaults to the cores per worker
+    Besides __call__ over all the pairs, documents can be solved one by one
+    with submit() while the caller goes on, and collected in order with
+    collect() (see DocumentPipeline).
+    '''
+
+    def __init__(self, label2idx, label2idx_c, backward=True, trans_only=False, workers=1,
+                 solver='gurobi', decoder='exact', cache=False, check=True, warm_start='none',
+                 solution_cache=None, **solver_args):
+        self.label2idx = label2idx
+        self.label2idx_c = label2idx_c
+        self.backward = backward
+        self.trans_only = trans_only
+        self.workers = workers
+        self.solver = solver
+        self.cache = cache
+        self.solver_args = solver_args
+        if (workers > 1) and (solver_args.get('threads') is None):
+            # processes x threads should not oversubscribe the cores
+            self.solver_args['threads'] = max(1, (os.cpu_count() or 1) // workers)
+        if decoder != 'exact':
+            self.solver = decoder
+            self.solver_args['exact'] = solver
+        self.check = check
+        self.warm_start = warm_start
+        self.solution_cache = solution_cache
+        self.solutions = {} # doc_id -> last (labels, labels_c), for warm_start='previous'
+        self.models = {} if cache else None # in-process cache
+        self.conns = None
+        self.procs = []
+        self.assignment = {} # doc_id -> worker
+        self.load = [0] * workers
+        self.pending = [] # submitted (task, solution cache key, worker or result)
+        self.ready = [] # worker -> queue of its results, filled by a receiver thread
+        self.receivers = []
+
+    def start(self, force=False):
+        # force: start a worker process even if workers <= 1
+        # a daemonic process (e.g. a cross-validation worker) cannot have children
+        if (self.conns is not None) or ((self.workers <= 1) and (not force)) or mp.current_process().daemon:
+            return
+        self.workers = max(self.workers, 1)
+        self.load = [0] * self.workers
+        self.ready = [queue.Queue() for w in range(self.workers)]
+        self.conns = []
+        for w in range(self.workers):
+            conn, child_conn = mp.Pipe()
+            proc = mp.Process(target=solver_worker, args=(child_conn, self.cache), daemon=True)
+            proc.start()
+            child_conn.close()
+            self.conns.append(conn)
+            self.procs.append(proc)
+        # a thread per worker always reads its results: a send of a large
+        # task must not wait for the worker while it waits to send a result
+        for conn, ready in zip(self.conns, self.ready):
+            receiver = threading.Thread(target=receive, args=(conn, ready), daemon=True)
+            receiver.start()
+            self.receivers.append(receiver)
+
+    def close(self):
+        if self.conns is not None:
+            for conn in self.conns:
+                conn.send(None)
+            for proc in self.procs:
+                proc.join()
+            for receiver in self.receivers:
+                receiver.join()
+        self.conns = None
+        self.procs = []
+        self.receivers = []
+        self.assignment = {}
+        self.load = [0] * self.workers
+        self.pending = []
+        self.ready = []
+        self.solutions = {}
+        self.models = {} if self.cache else None
+
+    def assign(self, tasks):
+        # new documents go to the least loaded worker, largest first
+        new = [i for i, task in enumerate(tasks) if task[0] not in self.assignment]
+        for i in sorted(new, key=lambda i: -len(tasks[i][2])):
+            w = int(np.argmin(self.load))
+            self.assignment[tasks[i][0]] = w
+            self.load[w] += len(tasks[i][2])
+
+    def dispatch(self, tasks):
+        self.assign(tasks)
+        batches = [[] for w in range(self.workers)]
+        for i, task in enumerate(tasks):
+            batches[self.assignment[task[0]]].append(i)
+        for conn, batch in zip(self.conns, batches):
+            conn.send([tasks[i] for i in batch])
+        results = [None] * len(tasks)
+        for ready, batch in zip(self.ready, batches):
+            solved = ready.get()
+            if isinstance(solved, Exception):
+                raise solved
+            for i, res in zip(batch, solved):
+                results[i] = res
+        return results
+
+    def task(self, doc, pairs, probs, pairs_c, probs_c):
+        # solve_document task of one document: pairs / probs are its forward
+        # half followed by its backward half
+        if probs_c.shape[0] == 0:
+            probs_c = np.zeros((0, 0))
+        start = None
+        if self.warm_start != 'none':
+            start = (np.argmax(probs, axis=1),
+                     np.argmax(probs_c, axis=1) if probs_c.shape[0] > 0 else np.zeros(0, dtype=int))
+            previous = self.solutions.get(doc)
+            if (self.warm_start == 'previous') and (previous is not None) and \
+                    (len(previous[0]) == len(pairs)) and (len(previous[1]) == len(pairs_c)):
+                start = previous
+        return (doc, self.solver, pairs, probs, pairs_c, probs_c, self.label2idx, self.label2idx_c,
+                self.backward, self.trans_only, self.solver_args, start, self.check)
+
+    def submit(self, task):
+        # solve a document while the caller goes on; results come from collect()
+        key = None
+        if self.solution_cache is not None:
+            key = self.solution_cache.key(task)
+            hit = self.solution_cache.get(key)
+            if hit is not None:
+                self.pending.append((task, None, hit))
+                return
+        self.start(force=True)
+        if self.conns is None:
+            result = solve_document(task, self.models)
+            if key is not None:
+                self.solution_cache.put(key, result)
+            self.pending.append((task, None, result))
+            return
+        self.assign([task])
+        w = self.assignment[task[0]]
+        self.conns[w].send([task])
+        self.pending.append((task, key, w))
+
+    def collect(self, verbose=True):
+        # results of the submitted documents, in order of submission
+        results = []
+        for task, key, w in self.pending:
+            if not isinstance(w, int):
+                results.append(w)
+                continue
+            solved = self.ready[w].get()
+            if isinstance(solved, Exception):
+                raise solved
+            if key is not None:
+                self.solution_cache.put(key, solved[0])
+            results.append(solved[0])
+        tasks = [task for task, key, w in self.pending]
+        self.pending = []
+        self.summary(tasks, results, verbose)
+        return results
+
+    def __call__(self, pairs, probs, pairs_c, probs_c, verbose=True):
+        '''
+        verbose: print the summary of the solves
+        return: temporal labels (N,), causal labels (Nc,)
+        '''
+        if probs_c.shape[0] == 0:
+            probs_c = np.zeros((0, 0))
+        pred_labels = np.argmax(probs, axis=1)
+        pred_labels_c = np.argmax(probs_c, axis=1) if probs_c.shape[0] > 0 else np.zeros(0, dtype=int)
+        docs = split_documents(pairs, pairs_c, self.backward)
+        tasks = [self.task(doc, [pairs[n] for n in idx], probs[idx], [pairs_c[n] for n in idx_c],
+                           probs_c[idx_c] if len(idx_c) > 0 else np.zeros((0, 0)))
+                 for doc, (idx, idx_c) in docs.items()]
+
+        results = [None] * len(tasks)
+        keys = [None] * len(tasks)
+        if self.solution_cache is not None:
+            for i, task in enumerate(tasks):
+                keys[i] = self.solution_cache.key(task)
+                results[i] = self.solution_cache.get(keys[i])
+        todo = [i for i in range(len(tasks)) if results[i] is None]
+        self.start()
+        if self.conns is not None:
+            solved = self.dispatch([tasks[i] for i in todo])
+        else:
+            solved = [solve_document(tasks[i], self.models) for i in todo]
+        for i, result in zip(todo, solved):
+            results[i] = result
+            if keys[i] is not None:
+                self.solution_cache.put(keys[i], result)
+
+        for (idx, idx_c), (labels, labels_c, c, o, st) in zip(docs.values(), results):
+            pred_labels[idx] = labels
+            if len(idx_c) > 0:
+                pred_labels_c[idx_c] = labels_c
+        self.summary(tasks, results, verbose)
+        return pred_labels, pred_labels_c
+
+    def summary(self, tasks, results, verbose=True):
+        # keep the solutions for warm_start='previous', print the telemetry
+        count = 0
+        obj = 0.0
+        stats = Counter()
+        for task, (labels, labels_c, c, o, st) in zip(tasks, results):
+            if self.warm_start == 'previous':
+                self.solutions[task[0]] = (np.array(labels, dtype=int), np.array(labels_c, dtype=int))
+            count += c
+            obj += o
+            stats.update(st)
+        if not verbose:
+            return
+        print('# of global correction: %s' % count)
+        print('Objective Function Value:', obj)
+        if self.check:
+            print('Consistency check: %s of %s documents skipped the solver' % (stats['consistent'], len(tasks)))
+        print('ILP solve time: %.2fs over %s documents' % (stats['solve_time'], len(tasks)))
+        if stats['started'] > 0:
+            print('Warm start (%s): %s of %s documents kept their start labels' %
+                  (self.warm_start, stats['start_kept'], stats['started']))
+        for key, name in (('started', 'with a start'), ('unstarted', 'without a start')):
+            if stats[key] > 0:
+                print('Solve per document %s: %.4fs, %.1f nodes over %s documents' %
+                      (name, stats[key + '_time'] / stats[key], float(stats[key + '_nodes']) / stats[key], stats[key]))
+        if self.cache:
+            print('Model cache: %s of %s documents reused' % (stats['reused'], len(tasks)))
+        if self.solution_cache is not None:
+            print('Solution cache: %s of %s documents hit, hit rate %.1f%% so far' %
+                  (stats['cache_hits'], len(tasks), 100.0 * self.solution_cache.hit_rate()))
+        if stats['vars'] > 0:
+            print('Presolve: %s of %s variables and %s of %s constraints eliminated' %
+                  (stats['vars_eliminated'], stats['vars'], stats['rows_eliminated'], stats['rows']))
+        if stats['greedy_conflicts'] > 0:
+            print('Decoder: %s documents fell back to the exact ILP' % stats['greedy_conflicts'])
+        if stats['lp_fractional'] > 0:
+            print('Decoder: fractional LP solution repaired for %s documents' % stats['lp_fractional'])
+        if stats['vars_folded'] > 0:
+            print('Symmetry: %s of %s variables substituted by their reverse pair, %s duplicate constraints dropped' %
+                  (stats['vars_folded'], stats['vars_unfolded'], stats['rows_folded']))
+        if stats['timeouts'] > 0:
+            print('Time limit: %s documents ran out of time, %s of them fell back to the argmax '
+                  '(%s with a lazy incumbent that broke transitivity)' %
+                  (stats['timeouts'], stats['timeout_argmax'], stats['timeout_inconsistent']))
+        if stats['pairs_released'] > 0:
+            print('Presolve: %s pairs released from conflicting fixings' % stats['pairs_released'])
+        if stats['presolve_undone'] > 0:
+            print('Presolve: fixings undone for %s documents' % stats['presolve_undone'])
+        if stats['triples'] > 0:
+            print('Lazy transitivity: %s of %s triples added in %s rounds' %
+                  (stats['lazy_triples'], stats['triples'], stats['lazy_rounds']))
+
+class DocumentPipeline():
+    '''
+    Overlap scoring and solving: add() the scores as the model computes them,
+    every document is submitted to the DocumentInference workers as soon as
+    all its pairs are in, while the caller scores the next ones.
+    finish() returns the labels in the order of the concatenated pairs
+    (forward rows, then backward rows), as DocumentInference.__call__ does.
+    expected: doc_id -> (#temporal pairs, #causal pairs), both directions
+    '''
+    kinds = (('L', False), ('L', True), ('C', False), ('C', True))
+
+    def __init__(self, inference, expected):
+        self.inference = inference
+        self.expected = expected
+        self.rows = OrderedDict() # doc_id -> {kind: [(pair, prob, row)]}
+        self.counts = Counter() # kind -> #rows so far
+        self.submitted = []
+
+    def add(self, pairs, probs, rev=False, causal=False):
+        # pairs: (docid_eventid, docid_eventid) keys of the rows of probs
+        kind = ('C' if causal else 'L', rev)
+        for pair, prob in zip(pairs, probs):
+            doc = pair[0].rsplit('_', 1)[0]
+            rows = self.rows.setdefault(doc, {k: [] for k in self.kinds})
+            rows[kind].append((pair, prob, self.counts[kind]))
+            self.counts[kind] += 1
+            n = len(rows[('L', False)]) + len(rows[('L', True)])
+            n_c = len(rows[('C', False)]) + len(rows[('C', True)])
+            if self.expected.get(doc) == (n, n_c):
+                self.submit(doc)
+
+    def submit(self, doc):
+        rows = self.rows[doc]
+        temporal = rows[('L', False)] + rows[('L', True)]
+        causal = rows[('C', False)] + rows[('C', True)]
+        probs = np.array([prob for pair, prob, row in temporal])
+        probs_c = np.array([prob for pair, prob, row in causal]) if len(causal) > 0 else np.zeros((0, 0))
+        self.inference.submit(self.inference.task(doc, [pair for pair, prob, row in temporal], probs,
+                                                  [pair for pair, prob, row in causal], probs_c))
+        self.submitted.append(doc)
+
+    def finish(self, verbose=True):
+        '''
+        return: temporal labels, causal labels of all the added rows
+        '''
+        done = set(self.submitted)
+        for doc in self.rows:
+            if doc not in done: # more or fewer pairs than expected
+                self.submit(doc)
+        results = self.inference.collect(verbose)
+        offset = {('L', False): 0, ('L', True): self.counts[('L', False)],
+                  ('C', False): 0, ('C', True): self.counts[('C', False)]}
+        pred_labels = np.zeros(self.counts[('L', False)] + self.counts[('L', True)], dtype=int)
+        pred_labels_c = np.zeros(self.counts[('C', False)] + self.counts[('C', True)], dtype=int)
+        for doc, (labels, labels_c, c, o, st) in zip(self.submitted, results):
+            rows = self.rows[doc]
+            for out, values, kinds in ((pred_labels, labels, self.kinds[:2]), (pred_labels_c, labels_c, self.kinds[2:])):
+                idx = [offset[k] + row for k in kinds for pair, prob, row in rows[k]]
+                if len(idx) > 0:
+                    out[idx] = values
+        self.rows = OrderedDict()
+        self.counts = Counter()
+        self.submitted = []
+        return pred_labels, pred_labels_c
+
+def document_inference(pairs, probs, pairs_c, probs_c, label2idx, label2idx_c,
+                       backward=True, trans_only=False, workers=1, solver='gurobi', verbose=True, **solver_args):
+    # one-off DocumentInference, nothing is kept after the call
+    inference = DocumentInference(label2idx, label2idx_c, backward=backward, trans_only=trans_only,
+                                  workers=workers, solver=solver, **solver_args)
+    try:
+        return inference(pairs, probs, pairs_c, probs_c, verbose=verbose)
+    finally:
+        inference.close()
+
+def compare_decoders(pairs, probs, pairs_c, probs_c, label2idx, label2idx_c, decoders=('lp', 'greedy'),
+                     **kwargs):
+    '''
+    Benchmark: run the exact ILP and every decoder on the same scores and
+    print their agreement with the exact labels and their speedup.
+    kwargs: passed on to document_inference
+    '''
+    results = []
+    for decoder in ('exact',) + tuple(decoders):
+        start_time = time.time()
+        labels, labels_c = document_inference(pairs, probs, pairs_c, probs_c, label2idx, label2idx_c,
+                                              decoder=decoder, **kwargs)
+        results.append((decoder, np.concatenate((labels, labels_c)), time.time() - start_time))
+    exact, exact_time = results[0][1], results[0][2]
+    print('%-8s %10s %10s %8s' % ('decoder', 'agreement', 'time(s)', 'speedup'))
+    for decoder, labels, t in results:
+        agreement = np.mean(labels == exact) if len(exact) > 0 else 1.0
+        print('%-8s %10.4f %10.3f %8.2f' % (decoder, agreement, t, exact_time / max(t, 1e-9)))
+    return results
@@ -22,8 +22,8 @@ from functools import partial
 from sklearn.model_selection import ParameterGrid
 from global_inference import temporal_awareness
 from temporal_evaluation import *
-from dataloader import get_data_loader
-from dataset import EventDataset
+from dataloader import get_data_loader, BucketBatchSampler
+from dataset import load_split
 
 torch.backends.cudnn.deterministic = True
 torch.backends.cudnn.benchmark = False
@@ -202,13 +202,13 @@ class NNClassifier(EveEveRelModel):
                     data_dir_back = args.data_dir + "all_backward_bertemb/"
                 else:
                     data_dir_back = args.data_dir + "all_backward/"
-            t_data = EventDataset(args.data_dir+type_dir,"train",args.glove2vocab,data_dir_back,args.bert_fts)
+            t_data = load_split(args, args.data_dir+type_dir, "train", data_dir_back)
             print('total train_data %s samples' %len(t_data))
-            d_data = EventDataset(args.data_dir+type_dir,"dev",args.glove2vocab,data_dir_back,args.bert_fts)
+            d_data = load_split(args, args.data_dir+type_dir, "dev", data_dir_back)
             print('total dev_data %s samples' %len(d_data))
             t_data.merge_dataset(d_data)
             print('total refit_data %s samples' %len(t_data))
-            train_data = get_data_loader(t_data, **params)
+            train_data = get_train_loader(t_data, params, args)
             dev_data = []
         
         best_f1, _ = self._train(train_data, dev_data, emb, pos_emb, args)
@@ -384,6 +384,7 @@ class NNClassifier(EveEveRelModel):
         torch.manual_seed(args.seed)
         torch.cuda.manual_seed(args.seed)
         model = BiLSTM(emb, pos_emb, args)
+        model.sorted_batches = args.bucket
         if args.cuda and torch.cuda.is_available():
             model = togpu(model)
         if args.sparse_emb and args.train_pos_emb:
@@ -601,11 +602,9 @@ class NNClassifier(EveEveRelModel):
             else:
                 backward_dir = args.data_dir + "all_backward/"
         
-        train_data = EventDataset(args.data_dir+type_dir,
-                                  "train", args.glove2vocab, backward_dir, args.bert_fts)
-        train_generator = get_data_loader(train_data, **params)
-        dev_data = EventDataset(args.data_dir+type_dir, 
-                                "dev", args.glove2vocab, backward_dir, args.bert_fts)
+        train_data = load_split(args, args.data_dir+type_dir, "train", backward_dir)
+        train_generator = get_train_loader(train_data, params, args)
+        dev_data = load_split(args, args.data_dir+type_dir, "dev", backward_dir)
         dev_generator = get_data_loader(dev_data, **params)
         
         seeds = [0, 10, 20]
@@ -678,11 +677,9 @@ class NNClassifier(EveEveRelModel):
             else:
                 backward_dir = "%scv_backward/fold%s/" % (args.data_dir, split)
 
-        train_data = EventDataset(args.data_dir+'%s/fold%s/'%(type_dir, split),
-                                  "train", args.glove2vocab, backward_dir, args.bert_fts)
-        train_generator = get_data_loader(train_data, **params)
-        dev_data = EventDataset(args.data_dir+'%s/fold%s/'%(type_dir, split), 
-                                "dev", args.glove2vocab, backward_dir, args.bert_fts)
+        train_data = load_split(args, args.data_dir+'%s/fold%s/'%(type_dir, split), "train", backward_dir)
+        train_generator = get_train_loader(train_data, params, args)
+        dev_data = load_split(args, args.data_dir+'%s/fold%s/'%(type_dir, split), "dev", backward_dir)
         dev_generator = get_data_loader(dev_data, **params)
         
         seeds = [0, 10, 20]
@@ -747,6 +744,16 @@ class NNClassifier(EveEveRelModel):
         #print(ClassificationReport('Inside weighted F1', gt, preds))
         return f1_score, weighted_f1_scores
 
+def get_train_loader(dataset, params, args):
+    # with bucket, batches of similar sentence lengths (of at most
+    # batch_tokens padded tokens if > 0); the evaluation keeps the dataset order
+    if not args.bucket:
+        return get_data_loader(dataset, **params)
+    sampler = BucketBatchSampler(dataset.lengths(), params['batch_size'], tokens=args.batch_tokens,
+                                 shuffle=True, seed=args.seed)
+    print(sampler.report())
+    return get_data_loader(dataset, params['batch_size'], batch_sampler=sampler)
+
 def main_local(args):
     data_dir = args.data_dir
     params = {'batch_size': args.batch,
@@ -761,12 +768,10 @@ def main_local(args):
             data_dir_back = args.data_dir + "all_backward_bertemb/"
         else:
             data_dir_back = args.data_dir + "all_backward/"
-    train_data = EventDataset(args.data_dir + type_dir, "train", 
-                              args.glove2vocab, data_dir_back, args.bert_fts)
+    train_data = load_split(args, args.data_dir + type_dir, "train", data_dir_back)
     print('total train_data %s samples' %len(train_data))
-    train_generator = get_data_loader(train_data, **params)
-    dev_data = EventDataset(args.data_dir + type_dir, "dev", 
-                            args.glove2vocab, data_dir_back, args.bert_fts)
+    train_generator = get_train_loader(train_data, params, args)
+    dev_data = load_split(args, args.data_dir + type_dir, "dev", data_dir_back)
     print('total dev_data %s samples' %len(dev_data))
     dev_generator = get_data_loader(dev_data, **params)
     
@@ -774,8 +779,7 @@ def main_local(args):
         data_dir_back = args.data_dir + "all_backward_bertemb/"
     else:
         data_dir_back = args.data_dir + "all_backward/"
-    test_data = EventDataset(args.data_dir + type_dir, "test", args.glove2vocab, 
-                             data_dir_back, args.bert_fts)
+    test_data = load_split(args, args.data_dir + type_dir, "test", data_dir_back)
     test_generator = get_data_loader(test_data, **params)
     
     models = [NNClassifier()]
@@ -26,6 +26,9 @@ class BiLSTM(nn.Module):
         self.attention = args.attention
         self.bert = args.bert_fts
         self.sparse=args.sparse_emb
+        # training batches come longest first (bucketed sampler), pack them
+        # without sorting; the evaluation batches keep the dataset order
+        self.sorted_batches = False
         
         ### embedding layer
         if self.bert:
@@ -116,7 +119,8 @@ class BiLSTM(nn.Module):
         pos = self.emb_pos(sent[1])
         # pack and pass to lstm module and then pad again
         inputs = torch.cat((emb, pos), dim=2)
-        pack_inputs = pack_padded_sequence(inputs, seq_lens, batch_first=True, enforce_sorted=False)
+        pack_inputs = pack_padded_sequence(inputs, seq_lens, batch_first=True,
+                                           enforce_sorted=self.sorted_batches and self.training)
         self.lstm.flatten_parameters()
         out, _ = self.lstm(pack_inputs)
         out, seq_lens = pad_packed_sequence(out, batch_first=True, padding_value=0.0) # (batch, seq_len, 2*hid_size)
@@ -0,0 +1,76 @@
+'''
+Solve the per-document problems dumped with -ilp_dump again, offline, under
+other backends, parameters and approximate decoders, and compare time and
+objective with the first configuration, e.g.
+    python replay_ilp.py -dump_dir ../ILP/dump -configs gurobi highs gurobi:lazy=True lp:exact=highs
+A configuration is solver[:key=value,...]; the values override the dumped
+config (lazy, fix, prune, threads, time_limit, mip_gap; exact for lp / greedy).
+'''
+import argparse
+import ast
+import glob
+import os
+import time
+import numpy as np
+from ilp_inference import load_problem, get_solver
+
+def parse_config(spec):
+    # 'solver:key=value,...' -> solver, kwargs
+    solver, _, items = spec.partition(':')
+    kwargs = {}
+    for item in filter(None, items.split(',')):
+        key, value = item.split('=', 1)
+        try:
+            kwargs[key.strip()] = ast.literal_eval(value.strip())
+        except (ValueError, SyntaxError): # a bare string, e.g. exact=highs
+            kwargs[key.strip()] = value.strip()
+    return solver, kwargs
+
+def replay(path, solver, kwargs):
+    '''
+    return: solve time, objective, labels (temporal then causal), whether the
+            labels satisfy every constraint, whether the solver found a solution
+    '''
+    problem, config = load_problem(path)
+    config.update(kwargs)
+    model = get_solver(solver)(*problem, **config)
+    start_time = time.time()
+    model.run()
+    elapsed = time.time() - start_time
+    model.predict(verbose=False)
+    labels = np.concatenate((np.array(model.pred_labels, dtype=int), np.array(model.pred_labels_c, dtype=int)))
+    return (elapsed, model.obj_val, labels, model.is_consistent(model.pred_labels, model.pred_labels_c),
+            model.solution is not None)
+
+if __name__ == '__main__':
+    p = argparse.ArgumentParser()
+    p.add_argument('-dump_dir', type=str, default="../ILP/dump/")
+    p.add_argument('-configs', type=str, nargs='+', default=['gurobi', 'highs', 'lp', 'greedy'])
+    # print every document whose objective differs from the first configuration
+    p.add_argument('-per_doc', action='store_true')
+    args = p.parse_args()
+
+    paths = sorted(glob.glob(os.path.join(args.dump_dir, '*.npz')))
+    print('%s documents in %s' % (len(paths), args.dump_dir))
+    results = []
+    for spec in args.configs:
+        solver, kwargs = parse_config(spec)
+        results.append([replay(path, solver, kwargs) for path in paths])
+
+    base = results[0]
+    base_time = sum(r[0] for r in base)
+    print('%-32s %10s %12s %12s %10s %8s %8s %8s' % ('config', 'time(s)', 'objective', 'obj. diff',
+                                                    'agreement', 'worse', 'failed', 'speedup'))
+    for spec, res in zip(args.configs, results):
+        t = sum(r[0] for r in res)
+        diff = np.array([r[1] - b[1] for r, b in zip(res, base)])
+        labels = np.concatenate([r[2] for r in res]) if res else np.zeros(0)
+        base_labels = np.concatenate([b[2] for b in base]) if base else np.zeros(0)
+        agreement = np.mean(labels == base_labels) if len(labels) > 0 else 1.0
+        print('%-32s %10.3f %12.4f %12.4f %10.4f %8d %8d %8.2f' %
+              (spec, t, sum(r[1] for r in res), diff.sum(), agreement, int((diff < -1e-6).sum()),
+               sum(not (r[3] and r[4]) for r in res), base_time / max(t, 1e-9)))
+        if args.per_doc:
+            for path, r, b, d in zip(paths, res, base, diff):
+                if abs(d) > 1e-6:
+                    print('    %s: objective %.4f (%+.4f), %.3fs' % (os.path.basename(path), r[1], d, r[0]))
@@ -0,0 +1,89 @@
+'''
+Checks that every data format reads the samples of the pickles:
+    cd code; python -m pytest -q test_dataset.py
+'''
+import json
+import os
+import pickle
+import numpy as np
+import pytest
+import torch
+from base import rev_label_ids
+from dataset import EventDataset, write_columns
+
+VOCAB = ['w%d' % i for i in range(30)]
+GLOVE2VOCAB = dict([('<pad>', 0), ('<unk>', 1)] + [(w, i + 2) for i, w in enumerate(VOCAB)])
+
+def make_samples(seed, bert, ndocs=3, npairs=8, dim=4):
+    # forward and backward samples as pickled by the feature extraction; the
+    # pairs of a document share two sentences, some samples are causal ('C')
+    rng = np.random.RandomState(seed)
+    rev_ids = rev_label_ids('tbd')
+    fwd, bwd = [], []
+    for d in range(ndocs):
+        sents = []
+        for s in range(2):
+            n = rng.randint(4, 12)
+            tokens = [VOCAB[k] for k in rng.randint(0, len(VOCAB), n)]
+            sents.append(([rng.rand(n, dim).tolist()] if bert else tokens, [int(p) for p in rng.randint(0, 36, n)]))
+        for k in range(npairs):
+            kind = 'C' if k % 4 == 3 else 'L'
+            sent, pos = sents[rng.randint(2)]
+            left, right = sorted(rng.choice(len(pos), 2, replace=False).tolist())
+            label = int(rng.randint(2 if kind == 'C' else len(rev_ids['L'])))
+            fts = rng.rand(15).tolist()
+            sample_id = '%s%d' % (kind, len(fwd))
+            for rev, out, y in ((False, fwd, label), (True, bwd, rev_ids[kind][label])):
+                out.append(('DOC%d' % d, sample_id, ('e%d' % k, 'e%d' % (k + 1)), y,
+                            (sent, pos, fts, rev, left, left, right, right, 0)))
+    return fwd, bwd
+
+@pytest.fixture(params=[False, True], ids=['glove', 'bert'])
+def data_dir(request, tmp_path):
+    # all/ and all_backward/ with train.pickle and its train.mmap conversion
+    bert = request.param
+    fwd, bwd = make_samples(0, bert)
+    for name, samples in (('all', fwd), ('all_backward', bwd)):
+        os.makedirs(str(tmp_path / name))
+        with open(str(tmp_path / name / 'train.pickle'), 'wb') as f:
+            pickle.dump(samples, f)
+        write_columns(samples, str(tmp_path / name / 'train.mmap'), bert)
+    return str(tmp_path) + '/', bert
+
+def same(a, b):
+    if torch.is_tensor(a):
+        return torch.is_tensor(b) and a.dtype == b.dtype and torch.equal(a, b)
+    if isinstance(a, (tuple, list)):
+        return type(a) == type(b) and len(a) == len(b) and all(same(x, y) for x, y in zip(a, b))
+    return type(a) == type(b) and a == b
+
+def assert_same(dataset, ref):
+    assert len(dataset) == len(ref)
+    assert dataset.sample_ids() == ref.sample_ids()
+    assert (dataset.lengths() == ref.lengths()).all()
+    assert dataset.documents() == ref.documents()
+    for i in range(len(ref)):
+        assert same(dataset[i], ref[i]), i
+
+def open_dataset(data_dir, bert, data_format='pickle', derive=False):
+    if derive:
+        return EventDataset(data_dir + 'all/', 'train', GLOVE2VOCAB, '', bert, data_format,
+                            rev_labels=rev_label_ids('tbd'))
+    return EventDataset(data_dir + 'all/', 'train', GLOVE2VOCAB, data_dir + 'all_backward/', bert, data_format)
+
+@pytest.mark.parametrize('data_format', ['mmap', 'tensor'])
+def test_formats(data_dir, data_format):
+    assert_same(open_dataset(*data_dir, data_format=data_format), open_dataset(*data_dir))
+
+@pytest.mark.parametrize('data_format', ['pickle', 'mmap', 'tensor'])
+def test_derive_backward(data_dir, data_format):
+    assert_same(open_dataset(*data_dir, data_format=data_format, derive=True), open_dataset(*data_dir))
+
+def test_shared_sentences(data_dir):
+    # each (doc, sentence) is stored once
+    data_dir, bert = data_dir
+    with open(data_dir + 'all/train.pickle', 'rb') as f:
+        samples = pickle.load(f)
+    with open(data_dir + 'all/train.mmap/meta.json') as f:
+        meta = json.load(f)
+    assert meta['sentences'] == len({(s[0], repr(s[4][0])) for s in samples}) < len(samples)
@@ -0,0 +1,228 @@
+'''
+Checks of the global inference on small random documents:
+    cd code; python -m pytest -q test_ilp_inference.py
+The gurobi cases are skipped without gurobipy.
+'''
+import itertools
+import threading
+from collections import OrderedDict
+import numpy as np
+import pytest
+from base import tbd_label_map, matres_label_map, causal_label_map
+from ilp_inference import get_solver, load_problem, split_documents, document_inference, DocumentInference, SolutionCache
+
+def label2idx(label_map):
+    labels = list(OrderedDict.fromkeys(label_map.values()))
+    return OrderedDict([(l, i) for i, l in enumerate(labels)])
+
+L_TBD = label2idx(tbd_label_map)
+L_MAT = label2idx(matres_label_map)
+L_C = label2idx(causal_label_map)
+
+def make_problem(seed, nevents, label2idx, causal=0, ndocs=1, backward=True):
+    # every pair of events of ndocs documents (both directions if backward),
+    # peaked random scores; causal: #forward pairs that also get a causal score
+    rng = np.random.RandomState(seed)
+    fwd = []
+    for d in range(ndocs):
+        for i, j in itertools.combinations(range(nevents), 2):
+            fwd.append(('DOC%d_e%d' % (d, i), 'DOC%d_e%d' % (d, j)))
+    pairs = fwd + [(b, a) for a, b in fwd] if backward else fwd
+    pairs_c = []
+    if causal > 0:
+        pairs_c = [fwd[n] for n in sorted(rng.choice(len(fwd), causal, replace=False))]
+        if backward:
+            pairs_c += [(b, a) for a, b in pairs_c]
+    def scores(n, P):
+        logits = rng.randn(n, P) * 3.0
+        return np.exp(logits) / np.exp(logits).sum(axis=1, keepdims=True)
+    probs_c = scores(len(pairs_c), len(L_C)) if pairs_c else np.zeros((0, 0))
+    return pairs, scores(len(pairs), len(label2idx)), pairs_c, probs_c
+
+# seed, #events, label set, #causal pairs, backward, trans_only
+CASES = [(0, 5, L_TBD, 0, True, False),
+         (1, 5, L_TBD, 0, True, True),
+         (2, 5, L_MAT, 0, True, False),
+         (3, 5, L_MAT, 0, False, False),
+         (4, 5, L_MAT, 3, True, False)]
+
+# both solvers stop within 0.01% of the optimum by default
+EXACT = {'mip_gap': 0.0}
+
+def solve(solver, case, **kwargs):
+    if solver == 'gurobi':
+        pytest.importorskip('gurobipy')
+    seed, nevents, l2i, causal, backward, trans_only = case
+    pairs, probs, pairs_c, probs_c = make_problem(seed, nevents, l2i, causal, backward=backward)
+    model = get_solver(solver)(pairs, probs, pairs_c, probs_c, l2i, L_C,
+                               backward=backward, trans_only=trans_only, **dict(EXACT, **kwargs))
+    model.run()
+    return model
+
+def labels(model):
+    # the argmax labels of the solution
+    x = model.solution
+    y = x[:model.N * model.P].reshape(model.N, model.P).argmax(axis=1)
+    yc = x[model.N * model.P:].reshape(model.Nc, model.Pc).argmax(axis=1) if model.Nc > 0 else []
+    return y, yc
+
+@pytest.mark.parametrize('case', CASES)
+@pytest.mark.parametrize('solver', ['highs', 'gurobi'])
+@pytest.mark.parametrize('options', [{}, {'lazy': True}])
+def test_exact_objective(case, solver, options):
+    # every exact backend and option reaches the optimum of the plain ILP
+    ref = solve('highs', case)
+    model = solve(solver, case, **options)
+    assert model.obj_val == pytest.approx(ref.obj_val, abs=1e-6)
+    assert model.is_consistent(*labels(model))
+
+@pytest.mark.parametrize('case', CASES)
+@pytest.mark.parametrize('options', [{'fix': 0.9}, {'prune': 0.02}, {'fix': 0.6, 'prune': 0.05}])
+def test_presolve_objective(case, options):
+    # the fixings change the problem the same way for every backend, and
+    # the solution stays feasible for the full ILP
+    highs = solve('highs', case, **options)
+    gurobi = solve('gurobi', case, **options)
+    assert highs.obj_val == pytest.approx(gurobi.obj_val, abs=1e-6)
+    assert highs.obj_val <= solve('highs', case).obj_val + 1e-6
+    assert highs.is_consistent(*labels(highs))
+
+@pytest.mark.parametrize('case', CASES)
+@pytest.mark.parametrize('solver', ['highs', 'gurobi'])
+@pytest.mark.parametrize('options', [{}, {'lazy': True}])
+def test_update(case, solver, options):
+    # a document grown one event at a time with update() ends at the
+    # solution of the whole document solved at once
+    if solver == 'gurobi':
+        pytest.importorskip('gurobipy')
+    seed, nevents, l2i, causal, backward, trans_only = case
+    pairs, probs, pairs_c, probs_c = make_problem(seed, nevents, l2i, causal, backward=backward)
+    full = get_solver('highs')(pairs, probs, pairs_c, probs_c, l2i, L_C,
+                               backward=backward, trans_only=trans_only, **dict(EXACT, **options))
+    full.run()
+    scores = dict(zip(pairs, probs))
+    scores_c = dict(zip(pairs_c, probs_c))
+    def chunk(k0, k1):
+        # the pairs whose later event is in events k0..k1-1
+        events = ['DOC0_e%d' % k for k in range(nevents)]
+        fwd = [(events[i], events[j]) for j in range(k0, k1) for i in range(j)]
+        fwd_c = [p for p in fwd if p in scores_c]
+        if backward:
+            fwd, fwd_c = fwd + [(b, a) for a, b in fwd], fwd_c + [(b, a) for a, b in fwd_c]
+        table = lambda ps, d, P: np.array([d[p] for p in ps]) if ps else np.zeros((0, P))
+        return fwd, table(fwd, scores, len(l2i)), fwd_c, table(fwd_c, scores_c, len(L_C))
+    p0, s0, c0, sc0 = chunk(0, 3)
+    model = get_solver(solver)(p0, s0, c0, sc0 if c0 else np.zeros((0, 0)), l2i, L_C,
+                               backward=backward, trans_only=trans_only, **dict(EXACT, **options))
+    model.run()
+    for k in range(3, nevents):
+        pk, sk, ck, sck = chunk(k, k + 1)
+        model.update(pk, sk, ck, sck if ck else None)
+    assert model.obj_val == pytest.approx(full.obj_val, abs=1e-6)
+    assert sorted(model.pairs) == sorted(full.pairs)
+    assert model.is_consistent(*labels(model))
+
+@pytest.mark.parametrize('case', CASES)
+@pytest.mark.parametrize('options', [{}, {'lazy': True}, {'fix': 0.6, 'prune': 0.05}])
+def test_dump(case, options, tmp_path):
+    # the dumped problem solves to the same objective when replayed, and so
+    # does its MPS file (with the fixed variables as objective constant)
+    model = solve('highs', case, **options)
+    path = str(tmp_path / 'doc')
+    model.dump(path)
+    problem, config = load_problem(path + '.npz')
+    replay = get_solver('highs')(*problem, **config)
+    replay.run()
+    assert replay.obj_val == pytest.approx(model.obj_val, abs=1e-6)
+    gurobipy = pytest.importorskip('gurobipy')
+    from gurobi_inference import get_env
+    mps = gurobipy.read(path + '.mps', env=get_env())
+    mps.setParam('MIPGap', 0.0)
+    mps.optimize()
+    assert mps.ObjVal == pytest.approx(model.obj_val, abs=1e-6)
+
+def test_solution_cache():
+    # a second call hits the cache for the documents whose scores quantise
+    # as before, and gets the labels a fresh solve would
+    pairs, probs, pairs_c, probs_c = make_problem(5, 4, L_MAT, 2, ndocs=3)
+    cache = SolutionCache(capacity=10, quantum=1e-3)
+    inference = DocumentInference(L_MAT, L_C, solver='highs', check=False, solution_cache=cache, **EXACT)
+    first = inference(pairs, probs, pairs_c, probs_c, verbose=False)
+    assert (cache.hits, cache.misses) == (0, 3)
+    # DOC1 moves to other grid points
+    moved = probs.copy()
+    doc1 = np.array([p[0].startswith('DOC1_') for p in pairs])
+    moved[doc1] = np.roll(moved[doc1], 1, axis=1)
+    second = inference(pairs, moved, pairs_c, probs_c, verbose=False)
+    assert (cache.hits, cache.misses) == (2, 4)
+    fresh = document_inference(pairs, moved, pairs_c, probs_c, L_MAT, L_C, solver='highs',
+                               check=False, verbose=False, **EXACT)
+    assert (second[0] == fresh[0]).all() and (second[1] == fresh[1]).all()
+    assert (second[0][~doc1] == first[0][~doc1]).all()
+    # a new configuration misses, and the oldest entries are evicted
+    other = DocumentInference(L_MAT, L_C, solver='highs', check=False, solution_cache=cache, lazy=True, **EXACT)
+    other(pairs, probs, pairs_c, probs_c, verbose=False)
+    assert (cache.hits, cache.misses) == (2, 7)
+    assert len(cache.entries) == 7
+    small = SolutionCache(capacity=2)
+    DocumentInference(L_MAT, L_C, solver='highs', solution_cache=small)(pairs, probs, pairs_c, probs_c, verbose=False)
+    assert [key[0] for key in small.entries] == ['DOC1', 'DOC2']
+
+def test_pipeline_large_documents():
+    # documents whose tasks and results overflow the pipes to the workers
+    # go through submit() / collect() without the two ends waiting on
+    # each other; the scores follow the event order, so the argmax is the
+    # solution and the check skips the solver
+    pairs, _, pairs_c, probs_c = make_problem(0, 120, L_MAT, 0, ndocs=4)
+    probs = np.full((len(pairs), len(L_MAT)), 0.01)
+    for n, (a, b) in enumerate(pairs):
+        before = int(a.rsplit('e', 1)[1]) < int(b.rsplit('e', 1)[1])
+        probs[n, L_MAT['BEFORE' if before else 'AFTER']] = 0.97
+    docs = split_documents(pairs, pairs_c)
+    inference = DocumentInference(L_MAT, L_C, solver='highs', workers=2)
+    results = []
+    def run():
+        for doc, (idx, idx_c) in docs.items():
+            inference.submit(inference.task(doc, [pairs[n] for n in idx], probs[idx], [], np.zeros((0, 0))))
+        results.extend(inference.collect(verbose=False))
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    thread.join(120)
+    assert not thread.is_alive(), 'submit / collect hung'
+    inference.close()
+    assert len(results) == 4
+    for (idx, idx_c), (labels, labels_c, count, obj_val, stats) in zip(docs.values(), results):
+        assert (labels == probs[idx].argmax(axis=1)).all()
+
+def test_lazy_timeout():
+    # a lazy solve that runs out of time right after the first round does
+    # not return the relaxed incumbent, which breaks transitivity
+    seed, nevents, l2i, causal, backward, trans_only = CASES[0]
+    pairs, probs, pairs_c, probs_c = make_problem(seed, nevents, l2i, causal, backward=backward)
+    model = get_solver('highs')(pairs, probs, pairs_c, probs_c, l2i, L_C, lazy=True, **EXACT)
+    optimize = model.optimize
+    def timed_out():
+        labels = optimize()
+        model.timed_out = True
+        return labels
+    model.optimize = timed_out
+    model.run()
+    assert model.stats['timeouts'] == 1
+    assert model.stats['timeout_inconsistent'] == 1
+    assert (model.solution == model.one_hot(probs.argmax(axis=1), [])).all()
+
+def test_distinct_rows():
+    # only exact duplicates are dropped: rows that differ by a hair, in
+    # their bounds or in the order their coefficients were given are kept
+    from scipy import sparse
+    rows = [([0, 1], [1.0, 1.0], 1.0, 1.0),
+            ([1, 0], [1.0, 1.0], 1.0, 1.0), # the first one, columns swapped
+            ([0, 1], [1.0, 1.0 + 1e-12], 1.0, 1.0),
+            ([0, 1], [1.0, 1.0], -np.inf, 1.0),
+            ([0, 2], [1.0, -1.0], -np.inf, 0.0),
+            ([0, 2], [1.0, -1.0], -np.inf, 0.0)]
+    A = sparse.csr_matrix((np.concatenate([r[1] for r in rows]),
+                           (np.repeat(np.arange(len(rows)), 2), np.concatenate([r[0] for r in rows]))), shape=(len(rows), 3))
+    model = solve('highs', CASES[0])
+    distinct = model.distinct_rows(A, np.array([r[2] for r in rows]), np.array([r[3] for r in rows]))
+    assert distinct.tolist() == [True, False, True, True, True, False]
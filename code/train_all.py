@@ -36,6 +36,13 @@ if __name__ == '__main__':
     p.add_argument('-teston', type=str, default='bothway',
                    choices=['forward', 'bothway', 'backward'])
     p.add_argument('-bert_fts', type=str2bool, default=True)
+    # mmap: the splits converted by convert_data.py, read without unpickling;
+    # tensor: the pickles converted to tensors once, when loaded
+    p.add_argument('-data_format', type=str, default='pickle',
+                   choices=['pickle', 'mmap', 'tensor'])
+    # derive the backward samples from the forward ones instead of reading
+    # the *_backward* directories
+    p.add_argument('-derive_backward', type=str2bool, default=True)
     p.add_argument('-bert_dim', type=int, default=768)
     p.add_argument('-n_fts', type=int, default=15)
     p.add_argument('-n_splits', type=int, default=5)
@@ -47,6 +54,48 @@ if __name__ == '__main__':
     p.add_argument('-selectparam', type=str2bool, default=False)
     p.add_argument('-refit_all', type=str2bool, default=False)
     p.add_argument('-ilp_dir', type=str, default="../ILP/bert/")
+    p.add_argument('-ilp_workers', type=int, default=1)
+    p.add_argument('-ilp_solver', type=str, default='gurobi',
+                   choices=['gurobi', 'highs'])
+    # exact: the ILP; lp / greedy: faster approximate decoders
+    p.add_argument('-ilp_decoder', type=str, default='exact',
+                   choices=['exact', 'lp', 'greedy'])
+    # compare the decoders on the dev / test scores
+    p.add_argument('-ilp_bench', type=str2bool, default=False)
+    # solve the documents in worker processes while the next ones are scored
+    p.add_argument('-ilp_pipeline', type=str2bool, default=False)
+    p.add_argument('-ilp_lazy', type=str2bool, default=False)
+    p.add_argument('-ilp_cache', type=str2bool, default=False)
+    # pre-solve reduction: fix pairs whose top score is >= ilp_fix, drop labels
+    # scoring < ilp_prune; inexact, off by default
+    p.add_argument('-ilp_fix', type=float, default=None)
+    p.add_argument('-ilp_prune', type=float, default=None)
+    p.add_argument('-ilp_check', type=str2bool, default=True)
+    # per solve: threads (default: solver's own, cores / ilp_workers with
+    # workers), time limit in seconds per document and relative MIP gap
+    p.add_argument('-ilp_threads', type=int, default=None)
+    p.add_argument('-ilp_time_limit', type=float, default=None)
+    p.add_argument('-ilp_gap', type=float, default=None)
+    # LRU cache of ilp_solution_cache document solutions (0: off), keyed by
+    # the scores quantised to ilp_quantum; shared by all runs of the process
+    p.add_argument('-ilp_solution_cache', type=int, default=0)
+    p.add_argument('-ilp_quantum', type=float, default=1e-3)
+    # save every solved document there, for replay_ilp.py
+    p.add_argument('-ilp_dump', type=str, default=None)
+    p.add_argument('-ilp_warm_start', type=str, default='none',
+                   choices=['none', 'argmax', 'previous'])
+    # global training: an ILP and optimizer step every doc_batch documents,
+    # 0 is one step over the whole corpus
+    p.add_argument('-doc_batch', type=int, default=0)
+    # global training: score without autograd, then recompute (same dropout
+    # masks) only the batches with a pair with a non-zero loss, backpropagated
+    # once they hold grad_batch pairs
+    p.add_argument('-two_phase', type=str2bool, default=False)
+    p.add_argument('-grad_batch', type=int, default=64)
+    # local training: batches of similar sentence lengths, of at most
+    # batch_tokens padded tokens if > 0 instead of batch samples
+    p.add_argument('-bucket', type=str2bool, default=False)
+    p.add_argument('-batch_tokens', type=int, default=0)
     p.add_argument('-write', type=str2bool, default=False)
     args_local = p.parse_args()
     args_global = p.parse_args()